@@ -0,0 +1,55 @@
+"""Import time of the pipeline modules and the heavy dependencies they load"""
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ("src.cli", "src.data.make_dataset", "src.features.build_features",
+           "src.visualization.visualize", "src.data.scrape_data")
+HEAVY = ("pandas", "numpy", "requests", "bs4", "halo", "folium", "matplotlib", "seaborn",
+         "sklearn")
+
+
+def import_time(module):
+    """
+    Cumulative import time of a module in a fresh interpreter, from -X importtime.
+
+    Returns
+    -------
+    seconds: float
+        Import time of the module, including the modules it imports.
+    heavy: list
+        Heavy dependencies loaded by the import.
+    """
+    code = "import sys, json, {}; print(json.dumps([m for m in {} if m in sys.modules]))".format(
+        module, list(HEAVY))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, check=True)
+    # Lines are "import time: self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6, json.loads(result.stdout)
+    raise RuntimeError("No import time reported for {}".format(module))
+
+
+def run(modules=MODULES, repeat=5):
+    results = {}
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            seconds, heavy = import_time(module)
+            times.append(seconds)
+        results[module] = {"seconds": min(times), "heavy": heavy}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, result in run(args.modules, args.repeat).items():
+        print("{:<30} {:>7.1f} ms  loads: {}".format(
+            name, result["seconds"] * 1000, ", ".join(result["heavy"]) or "-"))
@@ -0,0 +1,60 @@
+"""Pages per second of each html parsing backend over saved result pages"""
+import argparse
+import glob
+import os
+import time
+
+import pandas as pd
+
+from src.data.scrape_data import get_and_clean_data
+from .stub_server import render_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+BACKENDS = ("html.parser", "strainer", "lxml")
+
+
+def load_fixtures(n_pages=10):
+    """
+    Read the saved result pages, saving them first if they do not exist.
+
+    Returns
+    -------
+    pages: list
+        Html of each result page.
+    """
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for page in range(1, n_pages + 1):
+        path = os.path.join(FIXTURES_DIR, "result_page_{}.html".format(page))
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(render_page(page))
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))[:n_pages]:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+    return pages
+
+
+def run(n_pages=10, repeat=3):
+    pages = load_fixtures(n_pages)
+    reference = pd.concat([get_and_clean_data(p, "html.parser") for p in pages])
+    results = {}
+    for backend in BACKENDS:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            df = pd.concat([get_and_clean_data(p, backend) for p in pages])
+        elapsed = time.perf_counter() - start
+        results[backend] = {"pages_per_second": len(pages) * repeat / elapsed,
+                            "same_data": df.equals(reference)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for name, result in run(args.pages, args.repeat).items():
+        print("{:<12} {:>7.1f} pages/s  same data: {}".format(
+            name, result["pages_per_second"], result["same_data"]))
@@ -0,0 +1,324 @@
+"""Timing and memory of every pipeline stage over synthetic listings, saved as JSON and
+checked against thresholds and a previous run"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from .bench_parse import load_fixtures
+from .stub_server import StubGeocoder
+from .synthetic import generate_listings
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+THRESHOLDS = os.path.join(os.path.dirname(__file__), "thresholds.json")
+STAGES = ("parse", "clean.duplicates_and_na", "clean.outliers", "geocode", "geocode.cached",
+          "features", "train", "predict")
+
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """
+    Best wall time of func over some runs, and the peak of the memory it
+    allocated (traced in one more run, as tracing slows it down).
+
+    Parameters
+    ----------
+    func: callable
+        Called with the result of setup, returns the number of rows processed
+    setup: callable or None
+        Builds the input of each run, outside of the timing
+    repeat: int
+        Number of timed runs
+    memory: bool
+        Trace the memory of an extra run
+
+    Returns
+    -------
+    result: dict
+        seconds, rows, rows_per_second and peak_memory (bytes, None if not traced)
+    """
+    setup = setup or (lambda: None)
+    best = float("inf")
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        rows = func(data)
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        data = setup()
+        tracemalloc.start()
+        try:
+            func(data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"seconds": best, "rows": rows, "rows_per_second": rows / best, "peak_memory": peak}
+
+
+class Suite:
+    """
+    Results of the stages of a run, each one measured only if it was selected.
+
+    Parameters
+    ----------
+    stages: iterable
+        Stages to run, from STAGES
+    repeat: int
+        Timed runs of each stage
+    memory: bool
+        Trace the peak memory of each stage
+    """
+
+    def __init__(self, stages=STAGES, repeat=3, memory=True):
+        self.stages = stages
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def bench(self, name, func, setup=None, runs=None):
+        """
+        Measure a stage (see measure) if it was selected, printing its speed.
+        """
+        if name not in self.stages:
+            return
+        result = measure(func, setup, runs or self.repeat, self.memory)
+        self.results[name] = result
+        print("{:<24} {:>9.3f} s {:>12,.0f} rows/s".format(
+            name, result["seconds"], result["rows_per_second"]), file=sys.stderr)
+
+
+def bench_cleaning(suite, raw):
+    from src.data.improve_and_clean import remove_duplicates_and_na, remove_outliers
+    from src.data.scrape_data import get_and_clean_data
+
+    # Parsing of the saved result pages
+    pages = load_fixtures()
+    suite.bench("parse", lambda _: len(pd.concat([get_and_clean_data(p, "strainer")
+                                                  for p in pages])))
+
+    # Cleaning, on copies as it works in place
+    def clean_duplicates(df):
+        rows = len(df)
+        remove_duplicates_and_na(df)
+        return rows
+
+    def clean_outliers(df):
+        remove_outliers(df)
+        return len(df)
+
+    suite.bench("clean.duplicates_and_na", clean_duplicates, lambda: raw.copy())
+    interim = remove_duplicates_and_na(raw.copy())
+    suite.bench("clean.outliers", clean_outliers, lambda: interim.copy())
+
+
+def bench_geocoding(suite, addresses, work_dir):
+    from src.features import address_to_coordenates
+    from src.features.geocode_cache import GeocodeCache
+
+    # Every request goes to the stub and then every address hits the cache
+    cache_path = os.path.join(work_dir, "geocode_cache.sqlite")
+    api_url = address_to_coordenates.NOMINATIM_URL
+
+    def fresh_cache():
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return GeocodeCache(cache_path)
+
+    with StubGeocoder() as geocoder:
+        address_to_coordenates.NOMINATIM_URL = geocoder.url
+        try:
+            suite.bench("geocode", lambda cache: len(address_to_coordenates.geocode_batch(
+                addresses, cache, rate=1e6, max_workers=8)), fresh_cache)
+            suite.bench("geocode.cached", lambda cache: len(address_to_coordenates.geocode_batch(
+                addresses, cache)), lambda: GeocodeCache(cache_path))
+        finally:
+            address_to_coordenates.NOMINATIM_URL = api_url
+
+
+def bench_model(suite, located, train_rows, work_dir):
+    from src.data.storage import write_table
+    from src.models.predict_model import predict
+    from src.models.train_model import train_model
+
+    if "train" not in suite.stages and "predict" not in suite.stages:
+        return
+
+    # Training, a single run of a reduced search
+    train_file = os.path.join(work_dir, "train.csv")
+    model_dir = os.path.join(work_dir, "models")
+    write_table(located.head(train_rows), train_file)
+    model = {}
+
+    def train(_):
+        model["path"] = train_model(train_file, model_dir, n_jobs=1, cv=3, n_candidates=8)
+        return min(train_rows, len(located))
+
+    suite.bench("train", train, runs=1)
+
+    # Prediction of listings with coordinates
+    if "predict" in suite.stages:
+        if "path" not in model:
+            train(None)
+        listings = located.drop(columns="price")
+        suite.bench("predict", lambda _: len(predict(listings, model["path"], geocode=False)))
+
+
+def run(rows=100000, seed=0, repeat=3, memory=True, stages=STAGES, geocode_addresses=2000,
+        train_rows=50000, work_dir=None):
+    """
+    Benchmark the stages on the same synthetic listings.
+
+    Parameters
+    ----------
+    rows: int
+        Listings of the cleaning, feature and prediction stages (10k to 10M)
+    seed: int
+        Seed of the synthetic listings
+    repeat: int
+        Timed runs of each stage (training runs once)
+    memory: bool
+        Trace the peak memory of each stage
+    stages: iterable
+        Stages to run, from STAGES
+    geocode_addresses: int
+        Distinct addresses geocoded against the stub
+    train_rows: int
+        Listings the model is trained on
+    work_dir: str or None
+        Folder of the model and intermediate files, a temporary one if None
+
+    Returns
+    -------
+    results: dict
+        Result of measure for each stage
+    """
+    from src.features.combine_features import combine_features
+
+    work_dir = work_dir or tempfile.mkdtemp()
+    raw = generate_listings(rows, seed)
+    located = generate_listings(rows, seed, duplicates=0, outliers=0, coordinates=True)
+    suite = Suite(stages, repeat, memory)
+
+    bench_cleaning(suite, raw)
+    bench_geocoding(suite, raw["address"].drop_duplicates().head(geocode_addresses), work_dir)
+    # Features, with the neighbourhood aggregates
+    suite.bench("features", lambda _: len(combine_features(located)))
+    bench_model(suite, located, train_rows, work_dir)
+    return suite.results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, meta, results_dir=RESULTS_DIR):
+    """
+    Save a run as <results_dir>/<timestamp>-<commit>.json.
+
+    Returns
+    -------
+    path: str
+        Path of the saved run
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    name = "{}-{}.json".format(meta["date"].replace(":", "").replace("-", ""), meta["commit"])
+    path = os.path.join(results_dir, name)
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    return path
+
+
+def check(results, thresholds=None, baseline=None, max_slowdown=1.25):
+    """
+    Stages slower than their threshold or than the baseline run.
+
+    Parameters
+    ----------
+    results: dict
+        Results of run
+    thresholds: dict or None
+        Stage -> {'min_rows_per_second': float, 'max_peak_memory': int}
+    baseline: dict or None
+        Results of a previous run
+    max_slowdown: float
+        Largest accepted ratio between the seconds per row of a stage and of
+        the baseline
+
+    Returns
+    -------
+    failures: list
+        Description of each failed check
+    """
+    failures = []
+    for name, result in results.items():
+        failures += check_limits(name, result, (thresholds or {}).get(name, {}))
+        if baseline and name in baseline:
+            slowdown = baseline[name]["rows_per_second"] / result["rows_per_second"]
+            if slowdown > max_slowdown:
+                failures.append("{}: {:.2f}x slower than the baseline".format(name, slowdown))
+    return failures
+
+
+def check_limits(name, result, limits):
+    """
+    Failed checks of a stage against its 'min_rows_per_second' and
+    'max_peak_memory' limits.
+    """
+    failures = []
+    if result["rows_per_second"] < limits.get("min_rows_per_second", 0):
+        failures.append("{}: {:,.0f} rows/s, below {:,.0f}".format(
+            name, result["rows_per_second"], limits["min_rows_per_second"]))
+    if result["peak_memory"] and result["peak_memory"] > limits.get("max_peak_memory", float("inf")):
+        failures.append("{}: {:,} bytes, above {:,}".format(
+            name, result["peak_memory"], limits["max_peak_memory"]))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000, help="Listings, 10k to 10M")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stage", action="append", choices=STAGES,
+                        help="Stage to run, can be repeated (default all)")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace the memory")
+    parser.add_argument("--geocode-addresses", type=int, default=2000)
+    parser.add_argument("--train-rows", type=int, default=50000)
+    parser.add_argument("--thresholds", default=THRESHOLDS, help="JSON of the limits of each stage")
+    parser.add_argument("--baseline", help="JSON of a previous run to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=1.25)
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    args = parser.parse_args()
+
+    meta = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "rows": args.rows, "seed": args.seed, "repeat": args.repeat}
+    results = run(args.rows, args.seed, args.repeat, not args.no_memory,
+                  args.stage or STAGES, args.geocode_addresses, args.train_rows)
+    print(save_results(results, meta, args.results_dir))
+
+    thresholds = None
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    failures = check(results, thresholds, baseline, args.max_slowdown)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
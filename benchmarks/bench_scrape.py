@@ -0,0 +1,38 @@
+"""Compare the sequential and concurrent navigation against the stub server"""
+import argparse
+import tempfile
+import time
+
+from src.data.page_cache import PageCache
+from src.data.scrape_data import navigate, navigate_concurrent
+from .stub_server import StubServer
+
+
+def run(pages=40, latency=.05, max_in_flight=8):
+    results = {}
+    cache = PageCache(tempfile.mkdtemp())
+    with StubServer(pages=pages, latency=latency) as server:
+        for name, func, kwargs in [("sequential", navigate, {}),
+                                   ("concurrent", navigate_concurrent,
+                                    {"max_in_flight": max_in_flight}),
+                                   ("cache-fill", navigate_concurrent,
+                                    {"max_in_flight": max_in_flight, "cache": cache}),
+                                   ("cache-hit", navigate_concurrent,
+                                    {"max_in_flight": max_in_flight, "cache": cache})]:
+            start = time.perf_counter()
+            df = func(server.url, 1, pages, **kwargs)
+            elapsed = time.perf_counter() - start
+            results[name] = {"seconds": elapsed, "rows": len(df), "pages_per_second": pages / elapsed}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=.05)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    for name, result in run(args.pages, args.latency, args.max_in_flight).items():
+        print("{:<12} {:>7.2f} s  {:>6} rows  {:>7.1f} pages/s".format(
+            name, result["seconds"], result["rows"], result["pages_per_second"]))
@@ -0,0 +1,90 @@
+"""Load test of the price service: latency percentiles and requests per second"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+from src.models.serve import PriceService
+
+
+def load_listings(path="./data/processed/FINAL_DATA.csv", n=1000, seed=0):
+    """
+    Listings of the dataset without their price, as dicts.
+    """
+    df = pd.read_csv(path).drop(columns=["price"], errors="ignore")
+    df = df.sample(min(n, len(df)), random_state=seed)
+    return json.loads(df.to_json(orient="records"))
+
+
+def client(url, listings, n_requests, latencies, seed):
+    """
+    Send n_requests single-listing requests over one kept-alive connection.
+    """
+    rng = np.random.default_rng(seed)
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port)
+    headers = {"Content-Type": "application/json"}
+    for i in rng.integers(len(listings), size=n_requests):
+        body = json.dumps(listings[i])
+        start = time.perf_counter()
+        conn.request("POST", "/predict", body, headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError("HTTP {}".format(response.status))
+    conn.close()
+
+
+def run(url, listings, concurrency=16, n_requests=200):
+    latencies = []
+    threads = [threading.Thread(target=client, args=(url, listings, n_requests, latencies, seed))
+               for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {"requests": len(latencies),
+            "rps": len(latencies) / elapsed,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None,
+                        help="Running service, one is started in this process by default")
+    parser.add_argument("--models", default="./models")
+    parser.add_argument("--data", default="./data/processed/FINAL_DATA.csv")
+    parser.add_argument("--listings", type=int, default=1000,
+                        help="Distinct listings, fewer than requests exercises the cache")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per client")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait", type=float, default=.005)
+    parser.add_argument("--cache-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = PriceService(("127.0.0.1", 0), model_dir=args.models, cache_size=args.cache_size,
+                              max_batch=args.max_batch, max_wait=args.max_wait)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = server.url
+
+    result = run(url, load_listings(args.data, args.listings), args.concurrency, args.requests)
+    print("{requests} requests  {rps:.0f} req/s  p50 {p50_ms:.1f} ms  p99 {p99_ms:.1f} ms".format(
+        **result))
+    if server is not None:
+        print("{} batches, cache hits {} / misses {}".format(
+            server.batcher.batches, server.cache.hits, server.cache.misses))
+        server.shutdown()
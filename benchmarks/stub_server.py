@@ -0,0 +1,203 @@
+"""Local stand-ins for the search result website and the geocoding API"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CARD = """
+<div class="js-card-selector">
+  <article class="property-card__container">
+    <h2><a href="/imovel/{kind}-{n}-quartos-natal/">{kind} {n} quartos</a></h2>
+    <span class="property-card__address js-property-card-address"> {address} </span>
+    <ul class="property-card__details">
+      <li class="property-card__detail-item property-card__detail-area">
+        <span class="property-card__detail-value">{area}</span> m²</li>
+      <li class="property-card__detail-item property-card__detail-room">
+        <span class="property-card__detail-value">{bedrooms}</span> Quartos</li>
+      {suites}
+      <li class="property-card__detail-item property-card__detail-bathroom">
+        <span class="property-card__detail-value">{bathrooms}</span> Banheiros</li>
+      <li class="property-card__detail-item property-card__detail-garage">
+        <span class="property-card__detail-value">{parking_spots}</span> Vagas</li>
+    </ul>
+    <section class="property-card__values">
+      <div class="property-card__price js-property-card-prices"> R$ {price} </div>
+      <footer>Condomínio: <strong class="js-condo-price">R$ {condo}</strong></footer>
+    </section>
+  </article>
+</div>
+"""
+
+SUITES = """<li class="property-card__detail-item property-card__detail-item-extra">
+        <span class="property-card__detail-value">{}</span> Suítes</li>"""
+
+STREETS = ["Avenida Engenheiro Roberto Freire", "Rua Mossoró", "Avenida Prudente de Morais",
+           "Rua Jaguarari", "Avenida Ayrton Senna", "Rua Potengi", "Avenida Hermes da Fonseca"]
+NEIGHBOURHOODS = ["Ponta Negra", "Tirol", "Lagoa Nova", "Capim Macio", "Petrópolis",
+                  "Candelária", "Neópolis"]
+
+
+def render_page(page, cards=36):
+    """
+    Render a search result page with the same structure of the real one.
+
+    Parameters
+    ----------
+    page: int
+        Result page number, used as seed so pages are reproducible.
+    cards: int
+        Number of property cards in the page.
+
+    Returns
+    -------
+    html: str
+        Html of the result page.
+    """
+    rng = random.Random(page)
+    body = []
+    for _ in range(cards):
+        bedrooms = rng.randint(1, 5)
+        body.append(CARD.format(
+            kind=rng.choice(["apartamento", "casa", "terreno"]),
+            n=bedrooms,
+            address="{}, {} - {}, Natal - RN".format(
+                rng.choice(STREETS), rng.randint(1, 3000), rng.choice(NEIGHBOURHOODS)),
+            area=rng.randint(30, 400),
+            bedrooms=bedrooms,
+            suites=SUITES.format(rng.randint(0, bedrooms)) if rng.random() > .3 else "",
+            bathrooms=rng.randint(1, 5),
+            parking_spots=rng.randint(0, 4),
+            price="{:,}".format(rng.randint(80, 3000) * 1000).replace(",", "."),
+            condo=rng.randint(0, 1500)))
+    return "<html><body><div class=\"results-list\">{}</div></body></html>".format("".join(body))
+
+
+class StubServer:
+    """
+    Threaded HTTP server answering '/?pagina=N' with a rendered result page
+    and 404 after the last page. Pages carry an ETag and are answered with
+    '304 Not Modified' when revalidated. Use it as a context manager.
+
+    Parameters
+    ----------
+    pages: int
+        Number of existing result pages.
+    latency: float
+        Seconds waited before answering each request, simulating the network.
+    """
+
+    def __init__(self, pages=50, latency=.05):
+        self.pages = pages
+        self.latency = latency
+        self.requests = 0
+        self.not_modified = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                query = parse_qs(urlsplit(self.path).query)
+                page = int(query.get("pagina", ["1"])[0])
+                if page > stub.pages:
+                    self.send_error(404)
+                    return
+                body = render_page(page).encode("utf-8")
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if self.headers.get("If-None-Match") == etag:
+                    stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        """Search url of the first result page"""
+        return "http://127.0.0.1:{}/venda/?pagina=1".format(self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubGeocoder:
+    """
+    Threaded HTTP server answering Nominatim '/search?format=json&q=...'
+    requests. Addresses naming a neighbourhood of benchmarks.synthetic get
+    coordinates near its centre (the same for the same address), the others
+    an empty result. Use it as a context manager.
+
+    Parameters
+    ----------
+    latency: float
+        Seconds waited before answering each request, simulating the network.
+    """
+
+    def __init__(self, latency=0.):
+        from .synthetic import NEIGHBOURHOODS
+
+        self.latency = latency
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                address = parse_qs(urlsplit(self.path).query).get("q", [""])[0]
+                results = []
+                for name, (lat, lon, _, _) in NEIGHBOURHOODS.items():
+                    if name in address:
+                        rng = random.Random(address)
+                        results.append({"lat": str(lat + rng.gauss(0, .008)),
+                                        "lon": str(lon + rng.gauss(0, .006)),
+                                        "display_name": address})
+                        break
+                body = json.dumps(results).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        """Search url the address is appended to, as NOMINATIM_URL"""
+        return "http://127.0.0.1:{}/search?format=json&q=".format(self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
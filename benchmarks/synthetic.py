@@ -0,0 +1,140 @@
+"""Synthetic Natal listings with the columns, gaps and duplicates of the scraped data"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Neighbourhood: (lat, lon, price per m², weight in the listings), approximate
+NEIGHBOURHOODS = {
+    "Ponta Negra": (-5.8803, -35.1750, 6500, 18),
+    "Capim Macio": (-5.8600, -35.1990, 5500, 10),
+    "Tirol": (-5.7990, -35.2040, 6000, 10),
+    "Petrópolis": (-5.7930, -35.1980, 6200, 7),
+    "Lagoa Nova": (-5.8230, -35.2130, 5000, 12),
+    "Candelária": (-5.8380, -35.2110, 4800, 7),
+    "Neópolis": (-5.8660, -35.2170, 4000, 6),
+    "Barro Vermelho": (-5.8120, -35.2110, 5200, 5),
+    "Nova Descoberta": (-5.8260, -35.2030, 4200, 4),
+    "Lagoa Seca": (-5.8100, -35.2190, 3800, 3),
+    "Cidade Alta": (-5.7850, -35.2080, 3000, 3),
+    "Alecrim": (-5.8030, -35.2240, 2800, 3),
+    "Pitimbu": (-5.8680, -35.2320, 3200, 5),
+    "Ribeira": (-5.7760, -35.2050, 2900, 2),
+    "Areia Preta": (-5.7935, -35.1862, 5800, 3),
+    "Redinha": (-5.7440, -35.2050, 2600, 2),
+}
+
+STREETS = ["Avenida Engenheiro Roberto Freire", "Rua Mossoró", "Avenida Prudente de Morais",
+           "Rua Jaguarari", "Avenida Ayrton Senna", "Rua Potengi", "Avenida Hermes da Fonseca",
+           "Rua Poeta Jorge Fernandes", "Avenida Amintas Barros", "Rua Ceará Mirim",
+           "Rua Doutor Manoel Augusto Bezerra de Araújo", "Avenida Salgado Filho",
+           "Rua Rita Pereira de Macedo", "Avenida Deputado Antônio Florêncio de Queiroz",
+           "Rua Desembargador Hemetério Fernandes", "Rua Américo Soares Wanderley"]
+
+TYPES = {"apartment": .75, "house": .11, "other": .14}
+
+# Fraction of missing values of each column, as in the scraped data
+MISSING = {"area": .10, "bathrooms": .12, "bedrooms": .06, "condo": .40,
+           "parking_spots": .10, "price": .06, "suites": .16}
+
+COLUMNS = ["address", "area", "bathrooms", "bedrooms", "condo", "parking_spots", "price",
+           "suites", "type"]
+
+
+def generate_listings(n, seed=0, duplicates=.5, missing=True, outliers=.002, coordinates=False):
+    """
+    Listings spread over the neighbourhoods of Natal, with prices following
+    the price per m² of each neighbourhood.
+
+    Parameters
+    ----------
+    n: int
+        Number of listings
+    seed: int
+        Seed of the generator, the same seed gives the same listings
+    duplicates: float
+        Fraction of the listings that repeat another one (as pages overlap)
+    missing: bool
+        Leave values missing at the rates of the scraped data
+    outliers: float
+        Fraction of listings with absurd area or price
+    coordinates: bool
+        Add the 'lat' and 'lon' of the listings (what geocoding would give)
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Listings with the scraped columns
+    """
+    rng = np.random.default_rng(seed)
+    unique = max(1, int(n * (1 - duplicates)))
+    names = list(NEIGHBOURHOODS)
+    lat0, lon0, price_per_area, weight = (np.array(x, dtype='float64')
+                                          for x in zip(*NEIGHBOURHOODS.values()))
+    hood = rng.choice(len(names), size=unique, p=weight / weight.sum())
+    kind = rng.choice(list(TYPES), size=unique, p=list(TYPES.values()))
+
+    # Sizes and rooms
+    area = np.round(np.exp(rng.normal(4.5, .5, unique)))
+    bedrooms = np.clip(np.round(area / 35 + rng.normal(0, .7, unique)), 1, 6)
+    suites = np.clip(bedrooms - rng.integers(0, 3, unique), 0, None)
+    bathrooms = np.clip(suites + rng.integers(0, 2, unique), 1, None)
+    parking_spots = np.clip(np.round(bedrooms / 2 + rng.normal(0, .6, unique)), 0, 4)
+
+    # Prices
+    price = np.round(area * price_per_area[hood] * np.exp(rng.normal(0, .25, unique)), -3)
+    condo = np.where(kind == "apartment", np.round(area * rng.uniform(3, 9, unique), -1), 0)
+    bad = rng.random(unique) < outliers
+    area[bad] *= 100
+    price[rng.random(unique) < outliers] *= 100
+
+    # Addresses, some with the street only or the neighbourhood only
+    street = np.array(STREETS, dtype=object)[rng.integers(0, len(STREETS), unique)]
+    number = rng.integers(1, 4000, unique).astype(str).astype(object)
+    form = rng.random(unique)
+    place = np.array(names, dtype=object)[hood] + ", Natal - RN"
+    address = np.where(form < .7, street + ", " + number + " - " + place,
+                       np.where(form < .9, street + " - " + place, place))
+
+    df = pd.DataFrame({"address": address, "area": area, "bathrooms": bathrooms,
+                       "bedrooms": bedrooms, "condo": condo, "parking_spots": parking_spots,
+                       "price": price, "suites": suites, "type": kind})
+    if coordinates:
+        df["lat"] = lat0[hood] + rng.normal(0, .008, unique)
+        df["lon"] = lon0[hood] + rng.normal(0, .006, unique)
+    if missing:
+        for col, rate in MISSING.items():
+            df.loc[rng.random(unique) < rate, col] = np.nan
+
+    # Repeated listings
+    rows = np.concatenate([np.arange(unique), rng.integers(0, unique, n - unique)])
+    rng.shuffle(rows)
+    return df.iloc[rows].reset_index(drop=True)
+
+
+def write_listings(path, n, seed=0, chunksize=1000000, **kwargs):
+    """
+    Save n synthetic listings chunk by chunk, so 10M rows fit in memory.
+
+    Returns
+    -------
+    rows: int
+        Number of listings written
+    """
+    from src.data.storage import TableWriter
+
+    with TableWriter(path) as writer:
+        for i, start in enumerate(range(0, n, chunksize)):
+            writer.write(generate_listings(min(chunksize, n - start), seed + i, **kwargs))
+    return writer.rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output_file", help=".csv, .parquet or .feather file")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--coordinates", action="store_true", help="Add 'lat' and 'lon'")
+    args = parser.parse_args()
+
+    print(write_listings(args.output_file, args.rows, args.seed, coordinates=args.coordinates))
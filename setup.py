@@ -2,9 +2,13 @@ from setuptools import find_packages, setup
 
 setup(
     name='src',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     version='0.1.0',
     description='A data science project on collection, cleaning, manipulating and evaluating data regarding house prices',
     author='Fernando Henrique Fernandes',
     license='GNU-v3',
+    entry_points={
+        'console_scripts': ['estimada-morada=src.cli:main',
+                            'estimada-morada-serve=src.models.serve:main'],
+    },
 )
@@ -0,0 +1,149 @@
+"""Command line entry point running any subset of the pipeline stages"""
+import logging
+import os
+
+import click
+from dotenv import find_dotenv, load_dotenv
+
+from .data.formats import FORMATS, with_format
+from .data.stage_cache import STAGE_CACHE_DIR, StageCache
+from .utils import instrument
+
+STAGES = ('scrape', 'clean', 'gazetteer', 'geocode', 'features', 'train', 'predict')
+DEFAULT_STAGES = ('clean', 'gazetteer', 'geocode', 'features')
+
+
+def run_scrape(options):
+    from .data.make_dataset import read_urls, scrape_urls
+    scrape_urls(read_urls(), with_format(options['raw_file'], options['fmt']),
+                jobs=options['jobs'])
+
+
+def run_clean(options):
+    # Scraping inside process_dataset keeps the previous scraped file for
+    # the incremental diff
+    from .data.make_dataset import process_dataset
+    process_dataset(options['raw_file'], options['clean_file'], 'scrape' in options['stages'],
+                    incremental=options['incremental'], fmt=options['fmt'],
+                    chunksize=options['chunksize'], jobs=options['jobs'],
+                    stage_cache=options['stage_cache'])
+    options['clean_file'] = with_format(options['clean_file'], options['fmt'])
+
+
+def run_gazetteer(options):
+    # Offline geocoding of the streets and neighbourhoods already found
+    from .features.gazetteer import update_gazetteer
+    update_gazetteer()
+
+
+def run_geocode(options):
+    from .features.build_features import add_coordinates
+    add_coordinates(options['clean_file'], options['features_file'], options['force'],
+                    incremental=options['incremental'], fmt=options['fmt'],
+                    stage_cache=options['stage_cache'])
+
+
+def run_features(options):
+    # Geocodes the cleaned data too, without writing it to the features file
+    # when it is cached
+    from .features.build_features import add_features
+    add_features(options['clean_file'], options['features_file'], options['force'],
+                 incremental=options['incremental'], fmt=options['fmt'],
+                 stage_cache=options['stage_cache'])
+
+
+def run_train(options):
+    from .models.train_model import train_model
+    train_model(with_format(options['features_file'], options['fmt']), options['model_dir'],
+                n_jobs=options['jobs'])
+
+
+def run_predict(options):
+    from .models.predict_model import predict_file
+    predict_file(options['listings_file'] or with_format(options['features_file'], options['fmt']),
+                 with_format(options['predictions_file'], options['fmt']),
+                 chunksize=options['chunksize'] or 100000, model_dir=options['model_dir'])
+
+
+# Function running each stage, called with the options of main (and the stages run)
+STAGE_HANDLERS = {'scrape': run_scrape, 'clean': run_clean, 'gazetteer': run_gazetteer,
+                  'geocode': run_geocode, 'features': run_features, 'train': run_train,
+                  'predict': run_predict}
+
+# Stages done by another one when both run
+RUN_BY = {'scrape': 'clean', 'geocode': 'features'}
+
+
+@click.command()
+@click.argument('stages', nargs=-1, type=click.Choice(STAGES))
+@click.option('--raw', 'raw_file', default='./data/raw/SCRAPED_DATA.csv', show_default=True,
+              help='Scraped data file')
+@click.option('--clean', 'clean_file', default='./data/processed/CLEAN_DATA.csv', show_default=True,
+              help='Cleaned data file')
+@click.option('--features', 'features_file', default='./data/processed/FINAL_DATA.csv',
+              show_default=True, help='Data file with the coordinates and combined features')
+@click.option('--models', 'model_dir', default='./models', show_default=True,
+              help='Folder of the versioned trained models')
+@click.option('--listings', 'listings_file', default=None,
+              help='Listings priced by the predict stage, the features file by default')
+@click.option('--predictions', 'predictions_file', default='./data/processed/PREDICTIONS.csv',
+              show_default=True, help='Listings with their predicted price')
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help='Number of worker processes of the stages that run in parallel')
+@click.option('--incremental/--no-incremental', default=False,
+              help='Only process the listings that changed since the previous run')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default=None,
+              help='Format of the files written, the extension of each file is kept by default')
+@click.option('--chunksize', type=int, default=None,
+              help='Clean the dataset in chunks of this many rows, with bounded memory')
+@click.option('--force/--no-force', default=False,
+              help='Geocode the cleaned data again even if it did not change')
+@click.option('--stage-cache', default=STAGE_CACHE_DIR, show_default=True, type=click.Path(),
+              help='Folder of the outputs of the previous runs, the stages whose inputs, '
+                   'parameters and code did not change are skipped')
+@click.option('--keep', type=int, default=3, show_default=True,
+              help='Cached runs kept for each stage, the older ones are deleted')
+@click.option('--trace', 'trace_dir', default=None, type=click.Path(),
+              help='Save the timings, counters and memory of each stage in this folder, '
+                   'as metrics.json and trace.json (Chrome trace format)')
+@click.option('--profile', multiple=True, type=click.Choice(STAGES),
+              help='Profile a stage with cProfile, saved as profile-stage.<name>.prof '
+                   'in the --trace folder (or the current one)')
+def main(stages, raw_file, clean_file, features_file, model_dir, listings_file, predictions_file,
+         jobs, incremental, fmt, chunksize, force, stage_cache, keep, trace_dir, profile):
+    """ Run the STAGES of the pipeline, in order. Without STAGES, the scraped
+        data is cleaned, the gazetteer is built from the places geocoded so far,
+        the data is geocoded and its features are combined (scraping it first
+        if it does not exist).
+
+        Stages: scrape, clean, gazetteer, geocode, features, train and predict.
+    """
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    if trace_dir is not None or profile:
+        instrument.enable(['stage.' + stage for stage in profile], trace_dir or '.')
+
+    stages = set(stages or DEFAULT_STAGES)
+    options = dict(click.get_current_context().params, stages=stages)
+    for stage in STAGES:
+        if stage in stages and RUN_BY.get(stage) not in stages:
+            with instrument.span('stage.' + stage):
+                STAGE_HANDLERS[stage](options)
+
+    # Outputs of older runs
+    if stages & {'clean', 'geocode', 'features'}:
+        StageCache(stage_cache).gc(keep)
+
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+        instrument.RECORDER.save_json(os.path.join(trace_dir, 'metrics.json'))
+        instrument.RECORDER.save_chrome_trace(os.path.join(trace_dir, 'trace.json'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""File formats of the datasets, kept free of heavy imports"""
+import os
+
+# File extension of each format
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def file_format(path):
+    """
+    Format of a file from its extension.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    for fmt, fmt_ext in FORMATS.items():
+        if ext == fmt_ext:
+            return fmt
+    raise ValueError("Unknown file format: {}".format(path))
+
+
+def with_format(path, fmt=None):
+    """
+    Path with the extension of the given format. None keeps the path.
+    """
+    if fmt is None:
+        return path
+    return os.path.splitext(path)[0] + FORMATS[fmt]
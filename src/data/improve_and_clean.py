@@ -1,7 +1,16 @@
 """ Cleaning code to remove duplicates, outliers and improve the features of the dataset"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
 import pandas as pd
 
+from .storage import TableWriter, iter_table, read_table
+from ..utils.instrument import instrumented
+
 
+@instrumented('clean.remove_duplicates_and_na')
 def remove_duplicates_and_na(file, na_cols=('price', 'address', 'area', 'type')):
     """
     Briefly, this function cleans the data performing the following steps:
@@ -11,7 +20,7 @@ def remove_duplicates_and_na(file, na_cols=('price', 'address', 'area', 'type'))
     Parameters
     ----------
     file: str or pd.DataFrame
-        Name of the .csv  file  or df object
+        Name of the .csv (or .parquet, .feather) file or df object
     na_cols: iterable
         Names of the columns to drop values not available (NA)
 
@@ -23,7 +32,7 @@ def remove_duplicates_and_na(file, na_cols=('price', 'address', 'area', 'type'))
 
     # Load DataFrame from file
     if isinstance(file, str):
-        df = pd.read_csv(file)
+        df = read_table(file)
     else:
         df = file
 
@@ -37,6 +46,106 @@ def remove_duplicates_and_na(file, na_cols=('price', 'address', 'area', 'type'))
     return df
 
 
+def drop_duplicates_chunked(chunks, work_dir, max_rows=100000, buckets=16, _level=0):
+    """
+    Remove duplicated rows of a dataset given in chunks, with bounded memory.
+    Rows are distributed in bucket files by their hash, so identical rows
+    share a bucket, and each bucket is deduplicated in memory. Buckets
+    larger than max_rows are split again with other bits of the hash.
+    OBS.: rows come out grouped by bucket, not in the original order.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Chunks (pd.DataFrame) of the dataset, with the same dtypes
+    work_dir: str
+        Folder for the bucket files
+    max_rows: int
+        Maximum number of rows loaded at once
+    buckets: int
+        Number of buckets of each split
+
+    Yields
+    ------
+    df: pd.DataFrame
+        Chunk without duplicates
+    """
+    writers = [TableWriter(os.path.join(work_dir, 'bucket-{}-{:03d}.parquet'.format(_level, b)))
+               for b in range(buckets)]
+    shift = np.uint64(8 * _level)
+    for chunk in chunks:
+        # Sort the rows by bucket and write each slice to its bucket
+        hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        bucket_of_row = (hashes >> shift) % np.uint64(buckets)
+        order = np.argsort(bucket_of_row, kind='stable')
+        limits = np.searchsorted(bucket_of_row[order], np.arange(buckets + 1))
+        chunk = chunk.iloc[order]
+        for bucket, writer in enumerate(writers):
+            if limits[bucket + 1] > limits[bucket]:
+                writer.write(chunk.iloc[limits[bucket]:limits[bucket + 1]])
+
+    for writer in writers:
+        writer.close()
+        # Hash bits exhausted after 8 splits, the bucket only has duplicates
+        if writer.rows > max_rows and _level < 7:
+            yield from drop_duplicates_chunked(iter_table(writer.path, max_rows), work_dir,
+                                               max_rows, buckets, _level + 1)
+        elif writer.rows:
+            yield read_table(writer.path).drop_duplicates()
+        os.remove(writer.path)
+
+
+@instrumented('clean.clean_file_chunked')
+def clean_file_chunked(input_file, interim_file, output_file, chunksize=100000,
+                       na_cols=('price', 'address', 'area', 'type'), quantile=.995, margin=.5,
+                       cols=('area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots', 'price', 'suites'),
+                       sketch_size=100000):
+    """
+    Out-of-core version of remove_duplicates_and_na followed by
+    remove_outliers, whose peak memory depends on chunksize and sketch_size
+    but not on the dataset size:
+    1 - Remove duplicates (drop_duplicates_chunked) and empty entries of na_cols,
+        streaming the result to interim_file and into a QuantileSketch
+    2 - Stream interim_file again, removing the outliers with the approximate bounds
+
+    Parameters
+    ----------
+    input_file: str
+        Raw dataset (.csv, .parquet or .feather)
+    interim_file: str
+        Dataset without duplicates and missing values
+    output_file: str
+        Dataset also without outliers
+    chunksize: int
+        Maximum number of rows loaded at once
+    na_cols, quantile, margin, cols:
+        See remove_duplicates_and_na and remove_outliers
+    sketch_size: int
+        Size of the QuantileSketch sample
+
+    Returns
+    -------
+    rows: int
+        Number of rows written to output_file
+    """
+    sketch = QuantileSketch(cols, sketch_size)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(interim_file)))
+    try:
+        with TableWriter(interim_file) as interim:
+            for chunk in drop_duplicates_chunked(iter_table(input_file, chunksize), work_dir, chunksize):
+                chunk = chunk.dropna(subset=list(na_cols))
+                sketch.update(chunk)
+                interim.write(chunk)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    bounds = outlier_bounds(sketch, quantile, margin, cols, approximate=True)
+    with TableWriter(output_file) as output:
+        for chunk in iter_table(interim_file, chunksize):
+            output.write(remove_outliers(chunk, cols=cols, bounds=bounds))
+    return output.rows
+
+
 def join_dataframes(file_static, n, save=False):
     """
     Join multiple .cvs files created previously, removing unsuccessful 'lat' and 'lon' coordenates.
@@ -52,13 +161,12 @@ def join_dataframes(file_static, n, save=False):
     df: pd.DataFrame
         Final combined DataFrame
     """
-    # Placeholder
-    df = pd.DataFrame()
-    # Read all files and append them together
+    # Read all files and concatenate them once
+    df_pieces = []
     for i in range(n):
-        df_piece = pd.read_csv(file_static + str(i) + ".csv")
-        df_piece = df_piece[(df_piece.lat != 0) & (df_piece.lon != 0)]
-        df = df.append(df_piece)
+        df_piece = read_table(file_static + str(i) + ".csv")
+        df_pieces.append(df_piece[(df_piece.lat != 0) & (df_piece.lon != 0)])
+    df = pd.concat(df_pieces)
 
     # Save result
     if save:
@@ -67,8 +175,113 @@ def join_dataframes(file_static, n, save=False):
     return df
 
 
+class QuantileSketch:
+    """
+    Streaming approximation of the quantiles of some columns: a uniform
+    sample of fixed size of the rows seen so far (reservoir sampling), so
+    chunks of any dataset can be added one at a time with bounded memory.
+
+    Parameters
+    ----------
+    cols: iterable
+        Columns summarized
+    size: int
+        Number of rows kept in the sample. The quantile error is around 1/sqrt(size)
+    seed: int
+        Seed of the random sampling
+    """
+
+    def __init__(self, cols, size=100000, seed=0):
+        self.cols = list(cols)
+        self.size = size
+        self.count = 0
+        self._sample = np.empty((size, len(self.cols)))
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, df):
+        """
+        Add a chunk of rows to the sketch. Missing values count as zero.
+        """
+        values = df[self.cols].fillna(0).to_numpy(dtype=float)
+        n = len(values)
+
+        # Fill the sample while it is not full
+        fill = max(0, min(n, self.size - self.count))
+        self._sample[self.count:self.count + fill] = values[:fill]
+
+        # Then each new row replaces a random one with probability size / seen
+        if fill < n:
+            seen = self.count + np.arange(fill, n) + 1
+            slots = (self._rng.random(n - fill) * seen).astype(np.int64)
+            keep = slots < self.size
+            self._sample[slots[keep]] = values[fill:][keep]
+        self.count += n
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate quantile q of each column.
+
+        Returns
+        -------
+        quantiles: pd.Series
+            Quantile indexed by column
+        """
+        sample = self._sample[:min(self.count, self.size)]
+        return pd.Series(np.quantile(sample, q, axis=0), index=self.cols)
+
+
+def outlier_bounds(data, quantile=.995, margin=.5,
+                   cols=('area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots', 'price', 'suites'),
+                   approximate=False, sketch_size=100000):
+    """
+    Minimum and maximum valid values of each column, as used by remove_outliers.
+
+    Parameters
+    ----------
+    data: pd.DataFrame, iterable or QuantileSketch
+        Dataset, or chunks of it (pd.DataFrame) or a sketch already fed with
+        them when approximate is True
+    quantile: float
+        Percentile to use as reference before filtering df
+    margin: float
+        Value to use as margin (0 < margin <= 1)
+    cols: iterable
+        Columns to apply the filtering
+    approximate: bool
+        Estimate the quantiles with a QuantileSketch, in a single pass over the chunks
+    sketch_size: int
+        Size of the QuantileSketch sample
+
+    Returns
+    -------
+    quantiles_min: pd.Series
+        Minimum valid value of each column
+    quantiles_max: pd.Series
+        Maximum valid value of each column
+    """
+    cols = list(cols)
+    if approximate or isinstance(data, QuantileSketch):
+        sketch = data
+        if not isinstance(sketch, QuantileSketch):
+            sketch = QuantileSketch(cols, sketch_size)
+            for chunk in ([data] if isinstance(data, pd.DataFrame) else data):
+                sketch.update(chunk)
+        quantiles_max = sketch.quantile(quantile)
+        quantiles_min = sketch.quantile(1 - quantile)
+    else:
+        values = data[cols].fillna(0)
+        quantiles_max = values.quantile(quantile)
+        quantiles_min = values.quantile(1 - quantile)
+
+    # Add margins
+    return quantiles_min * (1 - margin), quantiles_max * (1 + margin)
+
+
+@instrumented('clean.remove_outliers')
 def remove_outliers(df, quantile=.995, margin=.5,
-                    cols=('area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots', 'price', 'suites')):
+                    cols=('area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots', 'price', 'suites'),
+                    bounds=None, approximate=False):
     """
     Remove invalid values in given dataset.
 
@@ -82,26 +295,26 @@ def remove_outliers(df, quantile=.995, margin=.5,
         Value to use as margin (0 < margin <= 1)
     cols: iterable
         Columns to apply the filtering
+    bounds: tuple or None
+        (quantiles_min, quantiles_max) computed by outlier_bounds, e.g. over
+        the whole dataset when df is one of its chunks. None computes them from df
+    approximate: bool
+        Use approximate quantiles, see outlier_bounds
 
     Returns
     -------
     df: pd.DataFrame
-        Filtered dataframe
+        Filtered dataframe, with missing values filled with zero
     """
-    # Fill missing values
-    local_df = df.fillna(0)
-
-    # Quantiles for each column
-    quantiles_max = local_df.quantile(quantile, axis=0)
-    quantiles_min = local_df.quantile(1 - quantile, axis=0)
-
-    # Add margins
-    quantiles_max *= 1 + margin
-    quantiles_min *= 1 - margin
+    cols = list(cols)
+    if bounds is None:
+        bounds = outlier_bounds(df, quantile, margin, cols, approximate)
+    quantiles_min, quantiles_max = bounds
 
-    for col in cols:
-        # Outliers for each column
-        local_df = local_df.fillna(0)
-        local_df = local_df[(local_df[col] >= quantiles_min[col]) & (local_df[col] <= quantiles_max[col])]
+    # Single mask of the rows valid in every column
+    values = df[cols].fillna(0)
+    mask = ((values >= quantiles_min[cols]) & (values <= quantiles_max[cols])).all(axis=1)
 
-    return local_df
+    # Missing numbers are zero
+    numeric_cols = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    return df[mask].fillna({col: 0 for col in numeric_cols})
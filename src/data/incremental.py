@@ -0,0 +1,108 @@
+"""Fingerprints of the listings, used to process only new or changed ones"""
+import os
+
+import pandas as pd
+
+from .storage import read_table
+
+# Fields collected by the scraper, the content of a listing
+SCRAPED_COLS = ('address', 'area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots',
+                'price', 'suites', 'type')
+STRING_COLS = ('address', 'type')
+
+
+def fingerprint(df, cols=SCRAPED_COLS):
+    """
+    Content hash of each listing. Values are normalized first (numbers as
+    floats, stripped strings) so the same listing has the same fingerprint
+    however it was loaded.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Listings with the scraped fields
+    cols: iterable
+        Fields hashed
+
+    Returns
+    -------
+    fingerprints: pd.Series
+        Hexadecimal fingerprint of each listing, with the index of df
+    """
+    normalized = pd.DataFrame(index=df.index)
+    for col in cols:
+        if col not in df.columns:
+            continue
+        if col in STRING_COLS:
+            normalized[col] = df[col].astype('string').str.strip()
+        else:
+            normalized[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+    hashes = pd.util.hash_pandas_object(normalized, index=False)
+    return hashes.map('{:016x}'.format).rename('fingerprint')
+
+
+def diff_listings(new, old):
+    """
+    Listings of the new scrape that were not in the old one, and fingerprints
+    of the old listings that are gone. A changed listing is both: its new
+    version is added and its old version removed.
+
+    Parameters
+    ----------
+    new: pd.DataFrame
+        Listings just scraped
+    old: pd.DataFrame or None
+        Listings of the previous scrape
+
+    Returns
+    -------
+    added: pd.DataFrame
+        New or changed listings, with a 'fingerprint' column
+    removed: pd.Index
+        Fingerprints of the old listings no longer present
+    """
+    new = new.assign(fingerprint=fingerprint(new))
+    if old is None:
+        return new, pd.Index([], name='fingerprint')
+    old_fingerprints = pd.Index(fingerprint(old).unique())
+    added = new[~new['fingerprint'].isin(old_fingerprints)]
+    removed = old_fingerprints.difference(pd.Index(new['fingerprint'].unique()))
+    return added, removed
+
+
+def merge_incremental(previous, added, removed):
+    """
+    Apply the processed new listings to the previous processed output.
+
+    Parameters
+    ----------
+    previous: pd.DataFrame
+        Previous output, with a 'fingerprint' column
+    added: pd.DataFrame
+        Processed new or changed listings, with a 'fingerprint' column
+    removed: iterable
+        Fingerprints of the listings to drop from previous
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Updated output
+    """
+    kept = previous[~previous['fingerprint'].isin(removed)]
+    kept = kept[~kept['fingerprint'].isin(added['fingerprint'])]
+    return pd.concat([kept, added], ignore_index=True)
+
+
+def load_previous(file):
+    """
+    Previous output of a stage, if it exists and has fingerprints.
+
+    Returns
+    -------
+    df: pd.DataFrame or None
+        Previous output, None if it can not be updated incrementally
+    """
+    if not os.path.exists(file):
+        return None
+    df = read_table(file)
+    return df if 'fingerprint' in df.columns else None
@@ -0,0 +1,126 @@
+"""Journal of the scraped result pages, used to resume interrupted crawls"""
+import json
+import os
+import time
+
+
+class CrawlJournal:
+    """
+    Append-only log recording, for each (url, page), whether it was scraped
+    or failed, when, and in which part file its rows were saved. Every entry
+    is flushed to disk as soon as it is written, so a crawl that dies keeps
+    all the pages finished until then.
+
+    Parameters
+    ----------
+    path: str
+        Path of the journal file (json lines).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Line cut by a crash while being written
+                        continue
+                    self._entries[(entry['url'], entry['page'])] = entry
+
+    def _write(self, entry):
+        self._entries[(entry['url'], entry['page'])] = entry
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_done(self, url, page, part, rows):
+        """
+        Record a page scraped successfully.
+
+        Parameters
+        ----------
+        url: str
+            Search url.
+        page: int
+            Result page number.
+        part: str
+            Path of the part file where the rows were saved.
+        rows: int
+            Number of rows saved.
+        """
+        self._write({'url': url, 'page': page, 'status': 'done', 'part': part,
+                     'rows': rows, 'time': time.time()})
+
+    def record_failed(self, url, page, error):
+        """
+        Record a page that could not be scraped.
+        """
+        self._write({'url': url, 'page': page, 'status': 'failed', 'error': str(error),
+                     'time': time.time()})
+
+    def _is_fresh(self, entry, max_age):
+        return entry['status'] == 'done' and (max_age is None or time.time() - entry['time'] <= max_age)
+
+    def failed_or_stale(self, url, max_age=None):
+        """
+        Pages of the url that failed or were scraped more than max_age seconds ago.
+
+        Returns
+        -------
+        pages: list
+            Sorted page numbers.
+        """
+        return sorted(page for (entry_url, page), entry in self._entries.items()
+                      if entry_url == url and not self._is_fresh(entry, max_age))
+
+    def pending_pages(self, url, page_initial=1, page_final=500, max_age=None):
+        """
+        Pages still to be scraped: the ones never finished, failed or stale.
+
+        Parameters
+        ----------
+        url: str
+            Search url.
+        page_initial: int
+            First result page of the crawl.
+        page_final: int
+            Last result page of the crawl.
+        max_age: float or None
+            Seconds after which a scraped page is stale. None never expires.
+
+        Returns
+        -------
+        pages: list
+            Sorted page numbers.
+        """
+        return [page for page in range(page_initial, page_final + 1)
+                if (url, page) not in self._entries
+                or not self._is_fresh(self._entries[(url, page)], max_age)]
+
+    def parts(self, urls=None):
+        """
+        Part files of the scraped pages, ordered by url and page.
+
+        Parameters
+        ----------
+        urls: list or None
+            Search urls, in order. None uses every url in the journal.
+        """
+        if urls is None:
+            urls = sorted({url for url, _ in self._entries})
+        return [self._entries[key]['part']
+                for url in urls
+                for key in sorted(k for k in self._entries if k[0] == url)
+                if self._entries[key]['status'] == 'done']
+
+    def clear(self):
+        """
+        Forget all the entries.
+        """
+        self._entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
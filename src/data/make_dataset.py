@@ -2,24 +2,131 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
-import time
-import pandas as pd
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import click
 from dotenv import find_dotenv, load_dotenv
-from .scrape_data import navigate
-from .improve_and_clean import remove_duplicates_and_na, remove_outliers
-from ..utils.utils import in_ipynb
-if in_ipynb():
-    from halo import HaloNotebook as Halo
-else:
-    from halo import Halo
-
-
-# @click.command()
-# @click.option('--scrape', type=click.BOOL, default=False,
-#               help='Wheather or not scrape the data from the urls on "/reference/urls.txt"')
-# @click.argument('input_file', type=click.Path())
-# @click.argument('output_file', type=click.Path())
-def process_dataset(input_file, output_file, scrape):
+from .formats import with_format
+from .journal import CrawlJournal
+from .stage_cache import STAGE_CACHE_DIR
+from ..utils.instrument import RECORDER, instrumented, recorded
+from ..utils.utils import get_spinner
+
+
+@instrumented('scrape.task')
+def scrape_task(url, pages, part_dir, journal_path, cache_dir=None, max_in_flight=1):
+    """
+    Scrape some result pages of a search url, saving each page as a part in
+    its own folder and journaling it. Runs in the worker processes of scrape_urls.
+
+    Returns
+    -------
+    rows: int
+        Number of rows scraped
+    """
+    # Scraping dependencies are only loaded by the processes that scrape
+    from .page_cache import PageCache
+    from .scrape_data import iter_pages
+    from .storage import PartSink
+
+    cache = PageCache(cache_dir) if cache_dir is not None else None
+    sink = PartSink(part_dir)
+    journal = CrawlJournal(journal_path)
+    on_error = partial(journal.record_failed, url)
+    rows = 0
+    for page, page_df in iter_pages(url, max_in_flight=max_in_flight, cache=cache, pages=pages,
+                                    on_error=on_error):
+        journal.record_done(url, page, sink.append(page_df), len(page_df))
+        rows += len(page_df)
+    return rows
+
+
+def read_urls(path='./references/urls.txt'):
+    """
+    Read the search urls to be scraped, one per line.
+    """
+    with open(path, 'r') as f:
+        urls = f.readlines()
+    return [url.strip() for url in urls if url.strip()]
+
+
+@instrumented('scrape.urls')
+def scrape_urls(urls, output_file, parts_dir='./data/interim/scrape_parts', jobs=1,
+                pages_per_task=50, page_final=500, cache_dir='./data/external/page_cache',
+                resume=True, max_age=24 * 3600, refetch_only=False, max_in_flight=1):
+    """
+    Scrape the result pages of many search urls and merge them in a single file.
+    The pages of each url are split in tasks of pages_per_task pages, which
+    run in a pool of jobs processes, each one writing its own part files.
+
+    Parameters
+    ----------
+    urls: list
+        Search urls, with 'pagina=1' in them
+    output_file: str
+        File where all the scraped data is merged
+    parts_dir: str
+        Folder where each scraped page is saved before being merged in output_file
+    jobs: int
+        Number of worker processes, 1 scrapes in this process
+    pages_per_task: int
+        Number of result pages of each task
+    page_final: int
+        Last result page of each url
+    cache_dir: str or None
+        Folder of the scraped pages cache, None to always download the pages
+    resume: bool
+        Keep the pages already scraped by a previous (interrupted) run
+    max_age: float or None
+        Seconds after which a page scraped by a previous run is scraped again
+    refetch_only: bool
+        Only scrape again the pages that failed or are stale
+    max_in_flight: int
+        Simultaneous requests of each worker
+    """
+    if not resume:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir, exist_ok=True)
+    journal_path = os.path.join(parts_dir, 'journal.jsonl')
+    journal = CrawlJournal(journal_path)
+
+    # Split the pending pages of every url in tasks
+    tasks = []
+    for i, url in enumerate(urls):
+        if refetch_only:
+            pages = journal.failed_or_stale(url, max_age)
+        else:
+            pages = journal.pending_pages(url, 1, page_final, max_age)
+        for start in range(0, len(pages), pages_per_task):
+            task_pages = pages[start:start + pages_per_task]
+            part_dir = os.path.join(parts_dir, 'url-{:03d}-page-{:04d}'.format(i, task_pages[0]))
+            tasks.append((url, task_pages, part_dir, journal_path, cache_dir, max_in_flight))
+
+    if jobs > 1 and len(tasks) > 1:
+        # The spans and counters of the workers are recorded with the ones of this process
+        task = partial(recorded, RECORDER.state(), scrape_task)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for _, worker_events in executor.map(task, *zip(*tasks)):
+                RECORDER.merge(worker_events)
+    else:
+        for task in tasks:
+            scrape_task(*task)
+
+    # Merge the parts journaled by all the workers, the ones of pages scraped
+    # again are deleted
+    from .storage import PartSink
+    journal = CrawlJournal(journal_path)
+    PartSink(parts_dir).merge(output_file, journal.parts(urls), keep=journal.parts())
+
+
+@instrumented('clean.process_dataset')
+def process_dataset(input_file, output_file, scrape, cache_dir='./data/external/page_cache',
+                    parts_dir='./data/interim/scrape_parts', resume=True, max_age=24 * 3600,
+                    refetch_only=False, incremental=False, fmt=None, chunksize=None, jobs=1,
+                    na_cols=('price', 'address', 'area', 'type'), quantile=.995, margin=.5,
+                    stage_cache=STAGE_CACHE_DIR):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
 
@@ -31,46 +138,155 @@ def process_dataset(input_file, output_file, scrape):
             Output processed file
         scrape: bool
             Force the scraping process
+        cache_dir: str or None
+            Folder of the scraped pages cache, None to always download the pages
+        parts_dir: str
+            Folder where each scraped page is saved before being merged in input_file
+        resume: bool
+            Keep the pages already scraped by a previous (interrupted) run
+        max_age: float or None
+            Seconds after which a page scraped by a previous run is scraped again
+        refetch_only: bool
+            Only scrape again the pages that failed or are stale
+        incremental: bool
+            Only clean the listings added or changed since the previous scraped
+            file and merge them into the previous outputs
+        fmt: str or None
+            Format of the files written ('csv', 'parquet' or 'feather'), None
+            keeps the extension of output_file. An existing input_file is read
+            in the format of its extension, only a newly scraped one uses fmt
+        chunksize: int or None
+            Clean the dataset in chunks of this many rows, with bounded memory
+            (see clean_file_chunked). Not used in incremental mode
+        jobs: int
+            Number of worker processes scraping the urls (see scrape_urls)
+        na_cols: iterable
+            Columns whose missing values drop the listing (see remove_duplicates_and_na)
+        quantile: float
+            Quantile of the outlier bounds (see remove_outliers)
+        margin: float
+            Margin of the outlier bounds (see remove_outliers)
+        stage_cache: str
+            Folder of the stage cache, the cleaning steps whose input, parameters
+            and code did not change since a cached run are skipped (see StageCache)
+
+        Returns
+        -------
+        final_data: pd.DataFrame or None
+            Cleaned dataset, None when cleaned in chunks (only saved to output_file)
     """
-    spinner = Halo(text='Making dataset...', spinner='dots')
+    from . import improve_and_clean, schema, storage
+    from .formats import file_format
+    from .improve_and_clean import clean_file_chunked, remove_duplicates_and_na, remove_outliers
+    from .incremental import diff_listings, load_previous, merge_incremental
+    from .stage_cache import StageCache
+    from .storage import read_table, write_table
+
+    spinner = get_spinner('Making dataset...')
     logger = logging.getLogger(__name__)
     logger.info('Making final dataset from raw data')
-    # Scrape data
+    output_file = with_format(output_file, fmt)
+    interim_file = output_file.replace("processed", "interim")
+    na_cols = list(na_cols)
+    previous_raw = None
+    if incremental and os.path.exists(input_file):
+        previous_raw = read_table(input_file)
+
+    # Scrape data, the website is the source so it is not cached
     if scrape or not os.path.exists(input_file):
+        input_file = with_format(input_file, fmt)
         spinner.start("Scraping data")
-        with open('./references/urls.txt', 'r') as f:
-            urls = f.readlines()
-        scraped_dfs = []
-        for url in urls:
-            scraped_dfs.append(navigate(url, 1, 500))
-        # Save results
-        raw_data = pd.concat(scraped_dfs)
-        raw_data.to_csv(input_file, index=False)
+        scrape_urls(read_urls(), input_file, parts_dir, jobs, cache_dir=cache_dir, resume=resume,
+                    max_age=max_age, refetch_only=refetch_only)
         spinner.succeed("Data Scrapped!")
     else:
-        spinner.succeed("Loading scraped file...")
-        raw_data = pd.read_csv(input_file)
         spinner.succeed("Scraped file already exists!")
+    cache = StageCache(stage_cache)
+    # The outputs depend on the code writing them and on their format too
+    code = [improve_and_clean, schema, storage]
+    output_format = file_format(output_file)
+
+    # Out-of-core cleaning, the dataset is never loaded at once
+    if chunksize and not incremental:
+        outputs = {'interim': interim_file, 'output': output_file}
+        key = cache.key('clean.chunked', [input_file], {'chunksize': chunksize, 'na_cols': na_cols,
+                        'quantile': quantile, 'margin': margin, 'format': output_format}, code)
+        entry = cache.get('clean.chunked', key)
+        if entry is not None:
+            cache.restore(entry, outputs)
+            spinner.succeed("Cleaned files are up to date!")
+            return None
+        spinner.start("Cleaning dataset in chunks...")
+        rows = clean_file_chunked(input_file, interim_file, output_file, chunksize, na_cols,
+                                  quantile, margin)
+        cache.put('clean.chunked', key, outputs)
+        spinner.succeed("Done cleaning, {} rows saved!".format(rows))
+        return None
 
     # Remove duplicates
     spinner.start("Removing duplicates and invalid values...")
-    time.sleep(1)
-    interim_data = remove_duplicates_and_na(raw_data)
-    interim_data.to_csv(output_file.replace("processed", "interim"), index=False)
-    spinner.succeed("Done removing duplicates!")
+    interim_data = None
+    if incremental:
+        raw_data = read_table(input_file)
+        previous_interim = load_previous(interim_file)
+        if previous_interim is not None and previous_raw is not None:
+            # Only the listings that changed since the previous scrape
+            added, removed = diff_listings(raw_data, previous_raw)
+            logger.info('%d new or changed listings, %d removed', len(added), len(removed))
+            interim_data = merge_incremental(previous_interim,
+                                             remove_duplicates_and_na(added, na_cols), removed)
+        else:
+            added, _ = diff_listings(raw_data, None)
+            interim_data = remove_duplicates_and_na(added, na_cols)
+        write_table(interim_data, interim_file)
+        spinner.succeed("Done removing duplicates!")
+    else:
+        key = cache.key('clean.duplicates_and_na', [input_file],
+                        {'na_cols': na_cols, 'format': output_format}, code)
+        deduplicated = cache.get('clean.duplicates_and_na', key)
+        if deduplicated is not None:
+            cache.restore(deduplicated, {'output': interim_file})
+            spinner.succeed("Duplicates already removed!")
+        else:
+            interim_data = remove_duplicates_and_na(read_table(input_file), na_cols)
+            write_table(interim_data, interim_file)
+            cache.put('clean.duplicates_and_na', key, {'output': interim_file})
+            spinner.succeed("Done removing duplicates!")
 
-    # Remove outliers
+    # Remove outliers, again only if the listings or the bounds changed
     spinner.start("Removing outliers and inconsistent values...")
-    time.sleep(1)
-    final_data = remove_outliers(interim_data)
-    final_data.to_csv(output_file, index=False)
-    spinner.succeed("Done removing outliers!")
+    key = cache.key('clean.outliers', [interim_file],
+                    {'quantile': quantile, 'margin': margin, 'format': output_format}, code)
+    entry = cache.get('clean.outliers', key)
+    if entry is not None:
+        cache.restore(entry, {'output': output_file})
+        final_data = read_table(output_file)
+        spinner.succeed("Outliers already removed!")
+    else:
+        if interim_data is None:
+            interim_data = read_table(interim_file)
+        final_data = remove_outliers(interim_data, quantile, margin)
+        write_table(final_data, output_file)
+        cache.put('clean.outliers', key, {'output': output_file})
+        spinner.succeed("Done removing outliers!")
     spinner.start("Cleaning processing done!")
     spinner.stop_and_persist(symbol='✔'.encode('utf-8'), text="Cleaning processing done!")
 
     return final_data
 
 
+@click.command()
+@click.argument('input_file', type=click.Path())
+@click.argument('output_file', type=click.Path())
+@click.option('--scrape/--no-scrape', default=False,
+              help='Wheather or not scrape the data from the urls on "/reference/urls.txt"')
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help='Number of worker processes scraping the urls')
+def main(input_file, output_file, scrape, jobs):
+    """ Clean the scraped INPUT_FILE into OUTPUT_FILE, scraping it first if needed."""
+    process_dataset(input_file, output_file, scrape, jobs=jobs)
+
+
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
@@ -79,7 +295,4 @@ if __name__ == '__main__':
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
 
-    input_file = "../../data/raw/SCRAPED_DATA.csv"
-    output_file = "../../data/processed/CLEAN_DATA.csv"
-
-    data = process_dataset(input_file, output_file, False)
+    main()
@@ -0,0 +1,93 @@
+"""On-disk cache of scraped result pages, validated with conditional requests"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from .schema import apply_schema
+
+
+class PageCache:
+    """
+    Keeps, for each url, the validators sent by the server (ETag and
+    Last-Modified) together with the rows already parsed from the page, so
+    an unchanged page costs a '304 Not Modified' and no parsing.
+
+    Parameters
+    ----------
+    directory: str
+        Folder where the cache entries are saved.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url, ext):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + ext)
+
+    def conditional_headers(self, url):
+        """
+        Headers that make the request conditional on the cached version.
+
+        Parameters
+        ----------
+        url: str
+            Url being requested.
+
+        Returns
+        -------
+        headers: dict
+            'If-None-Match' and/or 'If-Modified-Since' headers, empty if the
+            url is not cached.
+        """
+        meta_path = self._path(url, '.json')
+        if not os.path.exists(meta_path) or not os.path.exists(self._path(url, '.csv')):
+            return {}
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def load(self, url):
+        """
+        Rows parsed from the cached version of the page.
+
+        Returns
+        -------
+        df: pd.DataFrame or None
+            Cached rows, None if the url is not cached.
+        """
+        try:
+            return apply_schema(pd.read_csv(self._path(url, '.csv')))
+        except FileNotFoundError:
+            return None
+
+    def store(self, url, response, df):
+        """
+        Save the parsed rows of a page and its validators. Pages without
+        ETag or Last-Modified can not be revalidated and are not cached.
+
+        Parameters
+        ----------
+        url: str
+            Url requested.
+        response: requests.Response
+            Response of the request.
+        df: pd.DataFrame
+            Rows parsed from the response.
+        """
+        meta = {'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+        if not (meta['etag'] or meta['last_modified']):
+            return
+        df.to_csv(self._path(url, '.csv'), index=False)
+        with open(self._path(url, '.json'), 'w') as f:
+            json.dump(meta, f)
@@ -0,0 +1,84 @@
+"""Compact dtypes of the listing columns, shared by every loader"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Nullable integers for the counts and prices (whole numbers that may be
+# missing), wide enough for absurd scraped values to reach remove_outliers,
+# float32 for measures and coordinates and a categorical type
+SCHEMA = {
+    'address': 'string',
+    'type': 'category',
+    'fingerprint': 'string',
+    'area': 'float32',
+    'bathrooms': 'Int32',
+    'bedrooms': 'Int32',
+    'suites': 'Int32',
+    'parking_spots': 'Int32',
+    'condo': 'Int64',
+    'price': 'Int64',
+    'lat': 'float32',
+    'lon': 'float32',
+    'bedrooms_per_area': 'float32',
+    'price_per_area_knn': 'float32',
+    'density_500m': 'UInt32',
+    'density_1000m': 'UInt32',
+    'distance_to_centre': 'float32',
+    'distance_to_beach': 'float32',
+}
+
+
+def memory_usage(df):
+    """
+    Bytes used by a DataFrame, including the contents of string columns.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def apply_schema(df, schema=None, report=False):
+    """
+    Cast the known columns of df to their dtypes in the schema. Values that
+    do not fit a whole number dtype (e.g. 2.5 bathrooms) are rounded, and
+    the ones out of its range are set missing with a warning.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Dataset
+    schema: dict or None
+        Column -> dtype. (default to SCHEMA)
+    report: bool
+        Log the memory used before and after the conversion
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Dataset with the schema dtypes
+    """
+    schema = SCHEMA if schema is None else schema
+    dtypes = {col: dtype for col, dtype in schema.items()
+              if col in df.columns and str(df[col].dtype) != dtype}
+    if not dtypes:
+        return df
+
+    before = memory_usage(df) if report else 0
+    df = df.copy()
+    for col, dtype in dtypes.items():
+        if dtype.startswith(('UInt', 'Int')):
+            if not pd.api.types.is_integer_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col], errors='coerce').round()
+            limits = np.iinfo(dtype.lower())
+            out_of_range = (df[col] < limits.min) | (df[col] > limits.max)
+            if out_of_range.any():
+                logging.getLogger(__name__).warning(
+                    '%d values of %s out of the %s range set missing', out_of_range.sum(), col, dtype)
+                df[col] = df[col].mask(out_of_range)
+        df[col] = df[col].astype(dtype)
+
+    if report:
+        after = memory_usage(df)
+        logging.getLogger(__name__).info(
+            'Schema applied: %.1f MB -> %.1f MB (%.1f MB saved, %.1f bytes/row)',
+            before / 1e6, after / 1e6, (before - after) / 1e6, after / max(len(df), 1))
+    return df
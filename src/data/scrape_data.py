@@ -1,7 +1,43 @@
 """Scrapes the search URL and return the results as a DataFrame"""
-from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup, SoupStrainer
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+from ..utils.instrument import count, instrumented
+from ..utils.utils import RateLimiter
+from .schema import apply_schema
+
+# Shared pooled session, see get_session
+_SESSION = None
+
+
+def get_session(pool_size=16):
+    """
+    Return the session shared by all the requests of the scraper, so
+    connections are kept alive and reused between result pages.
+
+    Parameters
+    ----------
+    pool_size: int
+        Maximum number of connections kept open per host.
+
+    Returns
+    -------
+    session: requests.Session
+        Shared session.
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
 
 
 def get_position(navi_tree, string=True):
@@ -25,79 +61,172 @@ def get_position(navi_tree, string=True):
     return value
 
 
-def get_and_clean_data(page):
+def _soup_card(tag):
     """
-    Collects and cleans property information from 'Vila Real' website, for a given search result webpage.
+    Collect the property information of a result card parsed by bs4.
+    """
+    # Dictionary to save results
+    data = dict()
+    final_position = tag.find("article")
 
-    Parameters
-    ---------
-    page: requests.Response object
-        Result webpage with the information, result from request.get(url).
+    # Type of Property
+    type_value = final_position.h2.a['href']
+    if "apartamento" in type_value:
+        data['type'] = 'apartment'
+    elif "casa" in type_value:
+        data['type'] = 'house'
+    else:
+        data['type'] = 'other'
 
-    Returns
-    -------
-    df: pd.DataFramae
-        Dataframe with the information collected.
+    # Address
+    data['address'] = get_position(final_position.find("span", class_="js-property-card-address"))
+
+    # Price
+    data['price'] = get_position(final_position.find("div", class_="js-property-card-prices"))
+
+    # Condo
+    data['condo'] = get_position(final_position.section.find("strong", class_="js-condo-price"))
+
+    # Area
+    area_pos = final_position.find("li", class_="property-card__detail-area")
+    data['area'] = get_position(area_pos.find("span", class_="property-card__detail-value"))
+
+    # Bedrooms
+    bedrooms_pos = final_position.find("li", class_="property-card__detail-room")
+    data['bedrooms'] = get_position(bedrooms_pos.find("span", class_="property-card__detail-value"))
+
+    # Suites
+    suites_pos = final_position.find("li", class_="property-card__detail-item-extra")
+    if suites_pos:
+        data['suites'] = get_position(suites_pos.find("span", class_="property-card__detail-value"))
+    else:
+        data['suites'] = None
+
+    # Bathrooms
+    bath_pos = final_position.find("li", class_="property-card__detail-bathroom")
+    data['bathrooms'] = get_position(bath_pos.find("span", class_="property-card__detail-value"))
+
+    # Parking Spots
+    park_pos = final_position.find("li", class_="property-card__detail-garage")
+    data['parking_spots'] = get_position(park_pos.find("span", class_="property-card__detail-value"))
+
+    return data
+
+
+def _lxml_find(element, tag, class_):
+    """
+    First descendant of element with given tag and css class, as bs4's find.
     """
-    # BeautifulSoup object
-    soup = BeautifulSoup(page.text, 'html.parser')
+    found = element.xpath(".//{}[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]"
+                          .format(tag, class_))
+    return found[0] if found else None
 
-    # Main data holder
-    list_of_dicts = []
 
-    # Verifying results per page
-    results_list = soup.find_all("div", class_="js-card-selector")
-    assert(len(results_list) == 36)
-
-    # Only results tags
-    for tag in results_list:
-
-        # Dictionary to save results
-        data = dict()
-        final_position = tag.find("article")
-
-        # Type of Property
-        type_value = final_position.h2.a['href']
-        if "apartamento" in type_value:
-            data['type'] = 'apartment'
-        elif "casa" in type_value:
-            data['type'] = 'house'
+def _lxml_string(element):
+    """
+    Same value bs4's '.string' gives for an element parsed by lxml.
+    """
+    if element is None:
+        return None
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        return _lxml_string(children[0])
+    return None
+
+
+def _lxml_card(tag):
+    """
+    Collect the property information of a result card parsed by lxml.
+    """
+    data = dict()
+    final_position = tag.find(".//article")
+
+    # Type of Property
+    type_value = final_position.find(".//h2").find(".//a").get('href')
+    if "apartamento" in type_value:
+        data['type'] = 'apartment'
+    elif "casa" in type_value:
+        data['type'] = 'house'
+    else:
+        data['type'] = 'other'
+
+    data['address'] = _lxml_string(_lxml_find(final_position, "span", "js-property-card-address"))
+    data['price'] = _lxml_string(_lxml_find(final_position, "div", "js-property-card-prices"))
+    data['condo'] = _lxml_string(_lxml_find(final_position.find(".//section"), "strong", "js-condo-price"))
+    for col, class_ in [('area', 'property-card__detail-area'),
+                        ('bedrooms', 'property-card__detail-room'),
+                        ('suites', 'property-card__detail-item-extra'),
+                        ('bathrooms', 'property-card__detail-bathroom'),
+                        ('parking_spots', 'property-card__detail-garage')]:
+        position = _lxml_find(final_position, "li", class_)
+        if position is None:
+            data[col] = None
         else:
-            data['type'] = 'other'
+            data[col] = _lxml_string(_lxml_find(position, "span", "property-card__detail-value"))
+
+    return data
 
-        # Address
-        data['address'] = get_position(final_position.find("span", class_="js-property-card-address"))
 
-        # Price
-        data['price'] = get_position(final_position.find("div", class_="js-property-card-prices"))
+def _parse_cards(text, parser):
+    """
+    Parse the result cards of a page with the chosen backend.
+
+    Parameters
+    ----------
+    text: str
+        Html of the result page.
+    parser: str
+        'html.parser' builds the whole bs4 tree, 'strainer' makes bs4 build
+        only the result cards and 'lxml' uses lxml directly (fastest).
 
-        # Condo
-        data['condo'] = get_position(final_position.section.find("strong", class_="js-condo-price"))
+    Returns
+    -------
+    list_of_dicts: list
+        Property information of each result card.
+    """
+    if parser == 'lxml':
+        import lxml.html
+        tree = lxml.html.fromstring(text)
+        results_list = tree.xpath("//div[contains(concat(' ', normalize-space(@class), ' '), "
+                                  "' js-card-selector ')]")
+        card = _lxml_card
+    elif parser in ('html.parser', 'strainer'):
+        strainer = SoupStrainer("div", class_="js-card-selector") if parser == 'strainer' else None
+        soup = BeautifulSoup(text, 'html.parser', parse_only=strainer)
+        results_list = soup.find_all("div", class_="js-card-selector")
+        card = _soup_card
+    else:
+        raise ValueError("Unknown parser: {}".format(parser))
 
-        # Area
-        area_pos = final_position.find("li", class_="property-card__detail-area")
-        data['area'] = get_position(area_pos.find("span", class_="property-card__detail-value"))
+    # Verifying results per page
+    assert len(results_list) == 36
 
-        # Bedrooms
-        bedrooms_pos = final_position.find("li", class_="property-card__detail-room")
-        data['bedrooms'] = get_position(bedrooms_pos.find("span", class_="property-card__detail-value"))
+    return [card(tag) for tag in results_list]
 
-        # Suites
-        suites_pos = final_position.find("li", class_="property-card__detail-item-extra")
-        if suites_pos:
-            data['suites'] = get_position(suites_pos.find("span", class_="property-card__detail-value"))
-        else:
-            data['suites'] = None
 
-        # Bathrooms
-        bath_pos = final_position.find("li", class_="property-card__detail-bathroom")
-        data['bathrooms'] = get_position(bath_pos.find("span", class_="property-card__detail-value"))
+@instrumented('scrape.parse')
+def get_and_clean_data(page, parser='strainer'):
+    """
+    Collects and cleans property information from 'Vila Real' website, for a given search result webpage.
 
-        # Parking Spots
-        park_pos = final_position.find("li", class_="property-card__detail-garage")
-        data['parking_spots'] = get_position(park_pos.find("span", class_="property-card__detail-value"))
+    Parameters
+    ---------
+    page: requests.Response object or str
+        Result webpage with the information, result from request.get(url), or its html.
+    parser: str
+        Html parsing backend: 'html.parser', 'strainer' or 'lxml'. All produce the same data.
 
-        list_of_dicts.append(data)
+    Returns
+    -------
+    df: pd.DataFramae
+        Dataframe with the information collected.
+    """
+    text = page if isinstance(page, str) else page.text
+
+    # Main data holder
+    list_of_dicts = _parse_cards(text, parser)
 
     # Create Pandas DataFrame Objects
     df = pd.DataFrame(list_of_dicts)
@@ -119,10 +248,189 @@ def get_and_clean_data(page):
     for col in string_cols:
         df[col] = df[col].str.strip()
 
-    return df
+    # Compact dtypes
+    return apply_schema(df)
+
+
+def scrape_page(url, cache=None, parser='strainer'):
+    """
+    Request a result page and return its data. When a cache is given the
+    request is conditional and an unchanged page is not parsed again.
+
+    Parameters
+    ---------
+    url: str
+        Url of the result page.
+    cache: PageCache or None
+        Cache of previously scraped pages.
+    parser: str
+        Html parsing backend, see get_and_clean_data.
+
+    Returns
+    -------
+    webpage: requests.Response
+        Response of the request.
+    df: pd.DataFrame or None
+        Data collected from the page, None if the page could not be accessed.
+    """
+    headers = cache.conditional_headers(url) if cache is not None else {}
+    webpage = get_session().get(url, headers=headers)
+    count('requests')
+    count('bytes_received', len(webpage.content))
+
+    # Unchanged page
+    if webpage.status_code == 304:
+        count('not_modified')
+        return webpage, cache.load(url)
+
+    if not webpage.ok:
+        return webpage, None
+
+    df = get_and_clean_data(webpage, parser)
+    if cache is not None:
+        cache.store(url, webpage, df)
+    return webpage, df
+
+
+def page_url(main_url, page, page_initial=1):
+    """
+    Build the url of a given result page from the search url.
+    OBS.: the page_initial should be in the main_url.
+
+    Parameters
+    ----------
+    main_url: str
+        Complete url of the search result.
+    page: int
+        Result page to point the url to.
+    page_initial: int, optional
+        Numeric value of the page already in main_url. (default to 1)
+
+    Returns
+    -------
+    url: str
+        Url of the requested result page.
+    """
+    url_splitted = main_url.split('pagina=' + str(page_initial))
+    return url_splitted[0] + 'pagina=' + str(page) + url_splitted[1]
+
+
+class _PageWindow:
+    """
+    Pages of iter_pages requested ahead of the one being consumed, at most
+    size at a time, with one rate limiter per host shared by all workers.
+    """
+
+    def __init__(self, executor, urls, size, rate_limit=None, cache=None, parser='strainer'):
+        self.executor = executor
+        self.urls = urls
+        self.size = size
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.parser = parser
+        self.limiters = {}
+        self.in_flight = deque()
+        self.fill()
+
+    def __bool__(self):
+        return bool(self.in_flight)
+
+    def _fetch(self, url):
+        host = urlsplit(url).netloc
+        self.limiters.setdefault(host, RateLimiter(self.rate_limit)).acquire()
+        return scrape_page(url, self.cache, self.parser)
+
+    def fill(self):
+        """
+        Request the next pages until size of them are in flight.
+        """
+        while len(self.in_flight) < self.size:
+            page, url = next(self.urls, (None, None))
+            if page is None:
+                break
+            self.in_flight.append((page, self.executor.submit(self._fetch, url)))
+
+    def next_result(self, on_error=None):
+        """
+        Oldest page in flight and its (webpage, df), None if it raised and
+        on_error (called as on_error(page, exception)) handled it.
+        """
+        page, future = self.in_flight.popleft()
+        try:
+            return page, future.result()
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(page, error)
+            return page, None
+
+    def cancel(self):
+        for _, future in self.in_flight:
+            future.cancel()
+
+
+def iter_pages(main_url, page_initial=1, page_final=500, max_in_flight=1,
+               rate_limit=None, cache=None, parser='strainer', pages=None, on_error=None):
+    """
+    Requests the result pages from page_initial to page_final and yields the
+    data of each one as soon as it is parsed, in page order. Up to
+    max_in_flight pages are requested at the same time and the navigation
+    stops at the first page that could not be accessed.
+    OBS.: the page_initial should be in the main_url.
+
+    Parameters
+    ---------
+    main_url: str
+        Complete url of the search result.
+    page_initial: int, optional
+        Numeric value of te initial page search result. (default to 1)
+    page_final: int
+        Numeric value for final page to navigate
+    max_in_flight: int
+        Maximum number of simultaneous requests, 1 navigates sequentially.
+    rate_limit: float or None
+        Maximum number of requests per second sent to the same host.
+    cache: PageCache or None
+        Cache of previously scraped pages.
+    parser: str
+        Html parsing backend, see get_and_clean_data.
+    pages: iterable or None
+        Page numbers to request, in order, instead of page_initial to page_final.
+    on_error: callable or None
+        Called as on_error(page, exception) when a page raises while being
+        scraped, and the navigation goes on. None raises the exception.
+
+    Yields
+    ------
+    page: int
+        Result page number.
+    df: pd.DataFrame
+        Data collected from the page.
+    """
+    if pages is None:
+        pages = range(page_initial, page_final + 1)
+    urls = ((page, page_url(main_url, page, page_initial)) for page in pages)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        window = _PageWindow(executor, urls, max_in_flight, rate_limit, cache, parser)
+        try:
+            # Consume results in page order and keep the window full
+            while window:
+                page, result = window.next_result(on_error)
+                # Page not found interrupter
+                if result is not None and not result[0].ok:
+                    print('Page could not be accessed. HTML error code: {}'.format(result[0].status_code))
+                    return
+                window.fill()
+                if result is not None:
+                    yield page, result[1]
+
+            print("Navigation reached the last result page.")
+        finally:
+            window.cancel()
 
 
-def navigate(main_url, page_initial=1, page_final=500):
+@instrumented('scrape.navigate')
+def navigate(main_url, page_initial=1, page_final=500, cache=None, parser='strainer'):
     """
     Requests many websites alterating the page result in the url.
     OBS.: the page_initial should be in the main_url.
@@ -135,48 +443,37 @@ def navigate(main_url, page_initial=1, page_final=500):
         Numeric value of te initial page search result. (default to 1)
     page_final: int
         Numeric value for final page to navigate
+    cache: PageCache or None
+        Cache of previously scraped pages.
+    parser: str
+        Html parsing backend, see get_and_clean_data.
 
     Returns
     -------
     df: pd.DataFrane
         Dataframe which value will be saved on.
     """
-    # Create empty df
-    df = pd.DataFrame()
-    # Spit URL in static and dynamic parts
-    url_splitted = main_url.split('pagina=' + str(page_initial))
-    url_static = url_splitted[0] + 'pagina='
-    url_dynamic = str(page_initial) + url_splitted[1]
-
-    # Initial position
-    curr_page = page_initial
-
-    # Go through all URLs
-    while True:
-        # URL being explored
-        url = url_static + url_dynamic
-        webpage = requests.get(url)
-
-        # Page not found interrupter
-        if (not webpage.ok):
-            # raise Exception('Page could not be accessed. HTML error code: ', webpage.status_code)
-            print('Page could not be accessed. HTML error code: {}'.format(webpage.status_code))
-            break
-
-        # Final page reached interrupt
-        if curr_page > page_final:
-            print("Navigation reached the last result page.")
-            break
+    return navigate_concurrent(main_url, page_initial, page_final, max_in_flight=1,
+                               cache=cache, parser=parser)
 
-        # Append the gathered data
-        df = df.append(get_and_clean_data(webpage))
 
-        # Edit URL
-        curr_page += 1
-        url_dynamic = str(curr_page) + url_splitted[1]
+@instrumented('scrape.navigate_concurrent')
+def navigate_concurrent(main_url, page_initial=1, page_final=500,
+                        max_in_flight=8, rate_limit=None, cache=None, parser='strainer'):
+    """
+    Same as navigate, but keeps up to max_in_flight result pages being
+    requested at the same time. See iter_pages for the parameters.
 
-    # Return df
-    return df
+    Returns
+    -------
+    df: pd.DataFrane
+        Dataframe which value will be saved on.
+    """
+    dfs = [df for _, df in iter_pages(main_url, page_initial, page_final, max_in_flight,
+                                      rate_limit, cache, parser)]
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+"""Content-addressed cache of the outputs of the pipeline stages"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Changes when the layout of the cache changes, so older entries are not used
+CACHE_VERSION = 1
+
+# Folder of the stage cache of the pipeline
+STAGE_CACHE_DIR = './data/interim/stage_cache'
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    sha256 of the content of a file, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version(*modules):
+    """
+    Hash of the source files of the modules implementing a stage, so
+    editing them invalidates its entries.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Outputs of the pipeline stages, stored by their content hash under
+    objects/ and indexed by a key hashing everything a stage depends on:
+    its name, the content of its input files (or the outputs of upstream
+    entries), its parameters and the version of its code. A stage whose key
+    has an entry is skipped, its outputs copied back only where the files on
+    disk differ.
+    The digest of every file hashed is remembered with its size and mtime,
+    so unchanged files are not read again on the next run.
+
+    Parameters
+    ----------
+    directory: str
+        Folder of the cache, created if needed
+    """
+
+    def __init__(self, directory=STAGE_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+        self._digests_path = os.path.join(directory, 'digests.json')
+        self._digests = {}
+        if os.path.exists(self._digests_path):
+            with open(self._digests_path, encoding='utf-8') as f:
+                self._digests = json.load(f)
+
+    def digest(self, path):
+        """
+        sha256 of a file, read only if it changed since it was last hashed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._digests.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(path)
+        self._digests[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._write_json(self._digests_path, self._digests)
+        return digest
+
+    def key(self, stage, inputs=(), params=None, code=(), upstream=()):
+        """
+        Key of a run of a stage.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage
+        inputs: iterable
+            Paths of the files the stage reads
+        params: dict or None
+            Parameters changing the outputs, JSON serializable
+        code: iterable
+            Modules implementing the stage, see code_version
+        upstream: iterable
+            Entries (see get and put) whose outputs the stage reads
+
+        Returns
+        -------
+        key: str
+            Hexadecimal key
+        """
+        content = {'version': CACHE_VERSION, 'stage': stage,
+                   'inputs': [self.digest(path) for path in inputs],
+                   'upstream': [entry['outputs'] for entry in upstream],
+                   'params': params or {}, 'code': code_version(*code)}
+        serialized = json.dumps(content, sort_keys=True, default=list)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, stage, key):
+        return os.path.join(self.directory, 'entries', stage, key + '.json')
+
+    def object_path(self, digest, ext=''):
+        """
+        Path of a stored output, keeping the extension of the file it came from.
+        """
+        return os.path.join(self.directory, 'objects', digest[:2], digest + ext)
+
+    def get(self, stage, key):
+        """
+        Entry of a run of a stage, None if it is not cached (or some of its
+        outputs were lost).
+
+        Returns
+        -------
+        entry: dict or None
+            'stage', 'key', 'outputs' (name -> [digest, extension]) and 'used'
+        """
+        path = self._entry_path(stage, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            entry = json.load(f)
+        if not all(os.path.exists(self.object_path(*output)) for output in entry['outputs'].values()):
+            return None
+        entry['used'] = time.time()
+        self._write_json(path, entry)
+        return entry
+
+    def put(self, stage, key, outputs):
+        """
+        Store the output files of a run of a stage.
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage
+        key: str
+            Key of the run, see key
+        outputs: dict
+            Name -> path of each output file
+
+        Returns
+        -------
+        entry: dict
+            Entry of the run, see get
+        """
+        stored = {}
+        for name, path in outputs.items():
+            digest = self.digest(path)
+            ext = os.path.splitext(path)[1]
+            target = self.object_path(digest, ext)
+            if not os.path.exists(target):
+                self._copy(path, target)
+            stored[name] = [digest, ext]
+        entry = {'stage': stage, 'key': key, 'outputs': stored, 'used': time.time()}
+        os.makedirs(os.path.dirname(self._entry_path(stage, key)), exist_ok=True)
+        self._write_json(self._entry_path(stage, key), entry)
+        return entry
+
+    def output_path(self, entry, name):
+        """
+        Path of the stored copy of an output of an entry, to be read (not modified).
+        """
+        return self.object_path(*entry['outputs'][name])
+
+    def restore(self, entry, outputs):
+        """
+        Copy the outputs of an entry to their paths, leaving the files that
+        already have the same content untouched.
+
+        Parameters
+        ----------
+        entry: dict
+            Entry of a run, see get
+        outputs: dict
+            Name -> path the output is restored to
+
+        Returns
+        -------
+        restored: list
+            Names of the outputs copied
+        """
+        restored = []
+        for name, path in outputs.items():
+            digest, ext = entry['outputs'][name]
+            if os.path.splitext(path)[1] != ext:
+                # Bytes of one format must not be written under another extension
+                raise ValueError("Cached output '{}' is a {} file, can not restore it to {}"
+                                 .format(name, ext, path))
+            if os.path.exists(path) and self.digest(path) == digest:
+                continue
+            self._copy(self.output_path(entry, name), path)
+            stat = os.stat(path)
+            self._digests[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+            restored.append(name)
+        if restored:
+            self._write_json(self._digests_path, self._digests)
+        return restored
+
+    def gc(self, keep=3):
+        """
+        Drop all but the keep most recently used entries of each stage, the
+        stored outputs no entry refers to and the digests of deleted files.
+
+        Returns
+        -------
+        removed: int
+            Number of entries dropped
+        """
+        removed = 0
+        referenced = set()
+        entries_dir = os.path.join(self.directory, 'entries')
+        for stage in os.listdir(entries_dir):
+            entries = []
+            for name in os.listdir(os.path.join(entries_dir, stage)):
+                path = os.path.join(entries_dir, stage, name)
+                if not name.endswith('.json'):
+                    os.remove(path)
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    entries.append((json.load(f), path))
+            entries.sort(key=lambda item: item[0]['used'], reverse=True)
+            for entry, path in entries[keep:]:
+                os.remove(path)
+                removed += 1
+            for entry, _ in entries[:keep]:
+                referenced.update(self.object_path(*output) for output in entry['outputs'].values())
+
+        # Outputs of the dropped entries, and copies left by interrupted runs
+        for root, _, files in os.walk(os.path.join(self.directory, 'objects')):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in referenced:
+                    os.remove(path)
+
+        self._digests = {path: known for path, known in self._digests.items()
+                         if os.path.exists(path)}
+        self._write_json(self._digests_path, self._digests)
+        return removed
+
+    @staticmethod
+    def _copy(source, target):
+        # Written aside and renamed, so an interrupted copy is never used
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        tmp = '{}.tmp-{}'.format(target, os.getpid())
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp = '{}.tmp-{}'.format(path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
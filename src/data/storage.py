@@ -0,0 +1,300 @@
+"""Reading and writing of the datasets produced by the pipeline"""
+import glob
+import logging
+import os
+
+import pandas as pd
+
+from .formats import FORMATS, file_format, with_format
+from .schema import apply_schema
+from ..utils.instrument import count
+
+
+def read_table(path, columns=None):
+    """
+    Load a dataset saved by write_table (or any .csv), applying the schema.
+
+    Parameters
+    ----------
+    path: str
+        File with extension .csv, .parquet or .feather
+    columns: list or None
+        Only load these columns
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Dataset
+    """
+    fmt = file_format(path)
+    if fmt == 'parquet':
+        df = pd.read_parquet(path, columns=columns)
+    elif fmt == 'feather':
+        df = pd.read_feather(path, columns=columns)
+    else:
+        df = pd.read_csv(path, usecols=columns)
+    count('bytes_read', os.path.getsize(path))
+    return apply_schema(df, report=True)
+
+
+def write_table(df, path, fmt=None):
+    """
+    Save a dataset with the schema dtypes. Parquet and feather files are
+    compressed with zstd and keep the dtypes; both need pyarrow.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Dataset
+    path: str
+        Destination file, its extension is replaced when fmt is given
+    fmt: str or None
+        'csv', 'parquet' or 'feather'. None uses the extension of path
+
+    Returns
+    -------
+    path: str
+        Path of the written file
+    """
+    path = with_format(path, fmt)
+    fmt = file_format(path)
+    df = apply_schema(df).reset_index(drop=True)
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False, compression='zstd')
+    elif fmt == 'feather':
+        df.to_feather(path, compression='zstd')
+    else:
+        df.to_csv(path, index=False)
+    count('bytes_written', os.path.getsize(path))
+    return path
+
+
+def export_csv(path, output_file=None):
+    """
+    Export a dataset saved in any format as .csv.
+
+    Returns
+    -------
+    output_file: str
+        Path of the .csv file. (default to path with .csv extension)
+    """
+    output_file = output_file or with_format(path, 'csv')
+    read_table(path).to_csv(output_file, index=False)
+    return output_file
+
+
+def iter_table(path, chunksize=100000):
+    """
+    Load a dataset chunk by chunk, applying the schema to each chunk.
+    OBS.: feather files can not be read partially, they are loaded at once
+    and then split.
+
+    Parameters
+    ----------
+    path: str
+        File with extension .csv, .parquet or .feather
+    chunksize: int
+        Maximum number of rows of each chunk
+
+    Yields
+    ------
+    df: pd.DataFrame
+        Chunk of the dataset
+    """
+    fmt = file_format(path)
+    count('bytes_read', os.path.getsize(path))
+    if fmt == 'csv':
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            yield apply_schema(chunk)
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield apply_schema(batch.to_pandas())
+    else:
+        df = read_table(path)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+
+
+class TableWriter:
+    """
+    Writes a dataset to a single file one chunk at a time, keeping the
+    columns of the first chunk and the schema dtypes. Use it as a context
+    manager.
+    OBS.: feather files can not be appended to, their chunks are kept in
+    memory and written when the writer is closed.
+
+    Parameters
+    ----------
+    path: str
+        File with extension .csv, .parquet or .feather
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fmt = file_format(path)
+        self.rows = 0
+        self._columns = None
+        self._writer = None
+        self._chunks = []
+        if self.fmt == 'csv':
+            self._file = open(path, 'w', newline='', encoding='utf-8')
+
+    def write(self, df):
+        """
+        Append a chunk of rows to the file.
+        """
+        df = apply_schema(df)
+        if self._columns is None:
+            self._columns = list(df.columns)
+        df = df.reindex(columns=self._columns)
+
+        if self.fmt == 'csv':
+            df.to_csv(self._file, index=False, header=self.rows == 0)
+        elif self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            self._chunks.append(df)
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Finish writing the file.
+        """
+        if self.fmt == 'csv':
+            self._file.close()
+            count('bytes_written', os.path.getsize(self.path))
+        elif self._writer is not None:
+            self._writer.close()
+            count('bytes_written', os.path.getsize(self.path))
+        elif self.fmt == 'feather' or self._columns is None:
+            df = pd.concat(self._chunks, ignore_index=True) if self._chunks else pd.DataFrame()
+            write_table(df, self.path)
+            self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PartSink:
+    """
+    Append-only folder of part files. Each batch of rows is written to its
+    own part as soon as it arrives, so nothing accumulates in memory, and the
+    parts are concatenated once at the end.
+
+    Parameters
+    ----------
+    directory: str
+        Folder where the parts are written.
+    fmt: str
+        Format of the parts, 'csv', 'parquet' or 'feather'.
+    """
+
+    def __init__(self, directory, fmt='csv'):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown part format: {}".format(fmt))
+        self.directory = directory
+        self.fmt = fmt
+        os.makedirs(directory, exist_ok=True)
+        self._count = len(self.parts())
+
+    def parts(self):
+        """
+        Paths of the parts written so far, in writing order.
+        """
+        return sorted(glob.glob(os.path.join(self.directory, 'part-*.' + self.fmt)))
+
+    def append(self, df):
+        """
+        Write a batch of rows as a new part.
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            Rows to be written.
+
+        Returns
+        -------
+        path: str
+            Path of the written part.
+        """
+        path = os.path.join(self.directory, 'part-{:06d}.{}'.format(self._count, self.fmt))
+        write_table(df, path)
+        self._count += 1
+        return path
+
+    def read_part(self, path):
+        """
+        Load a single part.
+        """
+        return read_table(path)
+
+    def concat(self):
+        """
+        Load all the parts as a single DataFrame.
+        """
+        dfs = [self.read_part(path) for path in self.parts()]
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def merge(self, output_file, parts=None, keep=None):
+        """
+        Write all the parts to a single file, one part at a time, so memory
+        use does not depend on the number of parts (except for feather files,
+        see TableWriter). Without parts, output_file is left as it is.
+        The part files of the folder and its subfolders that are not kept
+        (e.g. of pages scraped again since) are deleted after the merge.
+
+        Parameters
+        ----------
+        output_file: str
+            Path of the final file.
+        parts: list or None
+            Paths of the parts to merge, in order. None merges every part.
+        keep: list or None
+            Paths of the parts kept for later merges, None keeps the merged ones.
+
+        Returns
+        -------
+        merged: int
+            Number of parts merged.
+        """
+        if parts is None:
+            parts = self.parts()
+        if not parts:
+            logging.getLogger(__name__).warning('No part to merge in %s, %s was not written',
+                                                self.directory, output_file)
+            return 0
+        with TableWriter(output_file) as writer:
+            for path in parts:
+                writer.write(self.read_part(path))
+        self._prune(parts if keep is None else keep)
+        return len(parts)
+
+    def _prune(self, keep):
+        # Part files no longer referenced, and the folders they leave empty
+        keep = {os.path.abspath(path) for path in keep}
+        pattern = os.path.join(self.directory, '**', 'part-*.' + self.fmt)
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.abspath(path) not in keep:
+                os.remove(path)
+                folder = os.path.dirname(path)
+                if os.path.abspath(folder) != os.path.abspath(self.directory) and not os.listdir(folder):
+                    os.rmdir(folder)
+
+    def clear(self):
+        """
+        Remove all the parts.
+        """
+        for path in self.parts():
+            os.remove(path)
+        self._count = 0
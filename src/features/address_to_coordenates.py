@@ -1,15 +1,67 @@
 """ Cleaning code to remove duplicates, outliers and improve the features of the dataset"""
 import pandas as pd
 import numpy as np
-import math
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import json
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from time import time
 
+from ..data.schema import apply_schema
+from ..data.storage import read_table
+from ..utils.instrument import count, instrumented
+from ..utils.utils import AdaptiveRateLimiter
+from .gazetteer import GAZETTEER_PATH, load_gazetteer
+from .geocode_cache import GEOCODE_CACHE_PATH, GeocodeCache, normalize_address
 
-def address2coord(address):
+# Nominatim API, the address is appended to it (the benchmarks point it to a stub)
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search?&format=json&q="
+
+# Shared session with retries, see get_session
+_SESSION = None
+
+
+def get_session():
+    """
+    Return the session shared by all the geocoding requests, with the
+    'requests' retry features mounted. Throttled responses are not retried
+    by the session, they are handled by the rate limiter.
+
+    Returns
+    -------
+    session: requests.Session
+        Shared session.
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        retry = Retry(20, backoff_factor=.5, respect_retry_after_header=False)
+        adapter = HTTPAdapter(max_retries=retry)
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+def retry_after(response):
+    """
+    Seconds asked by the 'Retry-After' header of a response, None if absent.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0., parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+@instrumented('geocode.request')
+def address2coord(address, limiter=None):
     """
     Return the latitude and longitude from given address. Uses Free Nomatim OpenStreetMap API.
     OBS.: Super slow...zZz
@@ -18,40 +70,45 @@ def address2coord(address):
     ----------
     address: str
         String with the address
+    limiter: AdaptiveRateLimiter or None
+        Rate limiter acquired before the request and told whether it was throttled
 
     Returns
     -------
     lat: float
-        Latitude of the address
+        Latitude of the address, 0 if not found and NaN if the API blocked the request
     lon: float
-        Longitude of the address
+        Longitude of the address, 0 if not found and NaN if the API blocked the request
     """
     # Organize address
     address = address.replace(' ', '+')
 
-    # Nominatim API
-    api_url = "https://nominatim.openstreetmap.org/search?&format=json&q="
-
-    # 'requests' retry features
-    session = requests.Session()
-    adapter = HTTPAdapter(max_retries=Retry(20, backoff_factor=.5))
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-
     # Get the response
-    r = session.get(api_url + address)
+    if limiter is not None:
+        limiter.acquire()
+    r = get_session().get(NOMINATIM_URL + address)
+    count('requests')
 
-    # Load as json
-    try:
-        json_as_list = json.loads(r.content)
-    except json.JSONDecodeError:
+    # Load as json, unless the request was throttled
+    blocked = r.status_code in (403, 429)
+    if not blocked:
+        try:
+            json_as_list = json.loads(r.content)
+        except json.JSONDecodeError:
+            blocked = True
+    if blocked:
         print("API blocked. Message: {}".format(r.content))
+        if limiter is not None:
+            limiter.penalize(retry_after(r))
+        return (np.nan, np.nan)
+    if limiter is not None:
+        limiter.reward()
 
     # Consider only the first result
     try:
         json_as_dict = json_as_list[0]
     # If no result is found
-    except json.JSONDecodeError:
+    except IndexError:
         json_as_dict = {'lat': 0, 'lon': 0}
 
     # Retrieve 'lat' and 'lon' from json dictionary
@@ -61,18 +118,154 @@ def address2coord(address):
     return (lat, lon)
 
 
-def apply_nomatin(file, na_cols=('price', 'address', 'area', 'type')):
+def _resolve_locally(keys, first_address, cache=None, gazetteer=None):
+    # Coordinates of the normalized addresses found in the cache or the
+    # gazetteer (and how many were cached), and the ones left for the API
+    found = cache.get_many(keys) if cache is not None else {}
+    cached = len(found)
+    misses = [key for key in keys if key not in found]
+    if gazetteer is not None:
+        for key in misses:
+            coords = gazetteer.lookup(first_address[key])
+            if coords is not None:
+                found[key] = coords
+        misses = [key for key in misses if key not in found]
+    return found, misses, cached
+
+
+def _fall_back_to_centroids(found, keys, first_address, gazetteer):
+    # Place the addresses without coordinates (or not found) at their neighbourhood
+    fallbacks = 0
+    for key in keys:
+        lat, lon = found.get(key, (np.nan, np.nan))
+        if np.isnan(lat) or (lat == 0 and lon == 0):
+            coords = gazetteer.centroid(first_address[key])
+            if coords is not None:
+                found[key] = coords
+                fallbacks += 1
+    count('centroid_fallbacks', fallbacks)
+
+
+def pending_addresses(addresses, cache=None, gazetteer=None):
+    """
+    Distinct addresses neither the cache nor the gazetteer resolve, the ones
+    a geocoding run sends to the API. After a run, these are the addresses
+    the API blocked, which are retried by the next run.
+
+    Parameters
+    ----------
+    addresses: iterable
+        Strings with the addresses
+    cache: GeocodeCache or None
+        Cache of the coordinates already found
+    gazetteer: Gazetteer or None
+        Local index of streets and neighbourhoods
+
+    Returns
+    -------
+    pending: list
+        Addresses to be sent to the API
+    """
+    addresses = pd.Series(list(addresses), dtype=object).dropna()
+    keys = addresses.map(normalize_address)
+    first_address = dict(zip(keys[::-1], addresses[::-1]))
+    _, misses, _ = _resolve_locally(keys.unique(), first_address, cache, gazetteer)
+    return [first_address[key] for key in misses]
+
+
+@instrumented('geocode.batch')
+def geocode_batch(addresses, cache=None, gazetteer=None, rate=1., max_workers=2, max_attempts=5,
+                  api=True):
+    """
+    Coordinates of many addresses. Identical addresses are looked up once,
+    the cache is consulted first, then the offline gazetteer, and only the
+    remaining misses go to the API (those it can not place fall back to the
+    centre of their neighbourhood). Requests run concurrently within the
+    allowed rate, which backs off when the API throttles and recovers after.
+
+    Parameters
+    ----------
+    addresses: iterable
+        Strings with the addresses
+    cache: GeocodeCache or None
+        Cache of the coordinates already found
+    gazetteer: Gazetteer or None
+        Local index of streets and neighbourhoods
+    rate: float
+        Maximum number of API requests per second (Nominatim's policy is 1)
+    max_workers: int
+        Maximum number of simultaneous API requests
+    max_attempts: int
+        Times a throttled address is requested before giving up (NaN result)
+    api: bool
+        Send the misses to the API, otherwise they are left as NaN (e.g. to
+        answer quickly from what is known locally)
+
+    Returns
+    -------
+    coords: pd.DataFrame
+        'lat' and 'lon' of each address, in the same order (NaN for missing addresses)
+    """
+    addresses = pd.Series(list(addresses), dtype=object)
+    # Missing addresses are never looked up (nor sent to the API as 'nan')
+    keys = addresses[addresses.notna()].map(normalize_address).reindex(addresses.index)
+    unique_keys = keys.dropna().unique()
+
+    # Served locally, from the cache and then the offline gazetteer
+    first_address = dict(zip(keys[::-1], addresses[::-1]))
+    found, misses, cached = _resolve_locally(unique_keys, first_address, cache, gazetteer)
+    count('cache_hits', cached)
+    if gazetteer is not None:
+        count('gazetteer_hits', len(found) - cached)
+
+    # Only the misses go out, one request per distinct address
+    limiter = AdaptiveRateLimiter(rate)
+
+    def geocode(key):
+        for _ in range(max_attempts):
+            lat, lon = address2coord(first_address[key], limiter)
+            if not np.isnan(lat):
+                # Blocked requests are not cached, so they are retried next time
+                if cache is not None:
+                    cache.put(key, lat, lon)
+                break
+        return key, (lat, lon)
+
+    if misses and api:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            found.update(executor.map(geocode, misses))
+
+    # Streets the API blocked or did not find, at the centre of their neighbourhood
+    if gazetteer is not None:
+        _fall_back_to_centroids(found, unique_keys, first_address, gazetteer)
+
+    coords = keys.map(found)
+    return pd.DataFrame({'lat': coords.map(lambda x: x[0], na_action='ignore'),
+                         'lon': coords.map(lambda x: x[1], na_action='ignore')}).astype('float64')
+
+
+@instrumented('geocode.apply_nomatin')
+def apply_nomatin(file, na_cols=('price', 'address', 'area', 'type'),
+                  cache_path=GEOCODE_CACHE_PATH,
+                  gazetteer_path=GAZETTEER_PATH):
     """
     Apply address2coord to every entry in 'address' and append results to a new column of the DataFrame:
     1 - Add 'lat' and 'lon' columns
     2 - Drop 'address' column
-    OBS.: The conversion of addres in coordenates is supper slow. Took ~3 hours
-    for ~8000 addresses conversions.
+    OBS.: The conversion of addres in coordenates is limited by the API rate
+    (1 request per second). Addresses already converted are
+    served from the cache in cache_path and addresses found in the
+    gazetteer in gazetteer_path do not need the API.
 
     Parameters
     ----------
     file: str or pd.DataFrame
-        Name of the .csv  file  or DataFrame object
+        Name of the .csv (or .parquet, .feather) file or DataFrame object
+    cache_path: str or None
+        Path of the geocoding cache database, None to always call the API
+    gazetteer_path: str or None
+        Path of the .csv gazetteer of streets and neighbourhoods (see
+        update_gazetteer), used if it exists
 
     Returns
     -------
@@ -82,41 +275,29 @@ def apply_nomatin(file, na_cols=('price', 'address', 'area', 'type')):
 
     # Load DataFrame from file
     if isinstance(file, str):
-        df = pd.read_csv(file)
+        df = read_table(file)
     else:
-        df = file
-
-    # Split df in n parts of maximum 1000 observations due to API limit
-    n = math.ceil(len(df) / 1000)
-    df_splitted = np.array_split(df, n)
-
-    for i, df_piece in enumerate(df_splitted):
-        # Get latitude and longitude
-        coord_series = df_piece['address'].apply(address2coord)  # Series
-        df_piece['lat'] = coord_series.apply(lambda x: x[0])     # Lat column
-        df_piece['lon'] = coord_series.apply(lambda x: x[1])     # Lon column
-
-        # Remove entries with missing values
-        df_piece = df_piece.dropna(subset=['lat', 'lon'])
-
-        # Replace missing values from bathrooms, bedrooms, condo, parking_spots, suites, condo with zero
-        fill_cols = ['bathrooms', 'bedrooms', 'condo', 'parking_spots', 'suites', 'condo']
-        df_piece[fill_cols] = df_piece[fill_cols].fillna(0)
+        df = file.copy()
 
-        # Drop address column
-        df_piece = df_piece.drop(['address'], axis=1)
+    # Get latitude and longitude
+    cache = GeocodeCache(cache_path) if cache_path is not None else None
+    coords = geocode_batch(df['address'], cache, load_gazetteer(gazetteer_path))
+    df['lat'] = coords['lat'].values
+    df['lon'] = coords['lon'].values
 
-        # Reset index again
-        df_piece = df_piece.reset_index(drop=True)
+    # Remove entries with missing or unsuccessful values
+    df = df.dropna(subset=['lat', 'lon'])
+    df = df[(df.lat != 0) & (df.lon != 0)]
 
-        # Save partial df
-        df_piece.to_csv("../../data/interim/Partial_nomatim_" + str(i) + ".csv", index=False)
+    # Replace missing values from bathrooms, bedrooms, condo, parking_spots, suites, condo with zero
+    fill_cols = ['bathrooms', 'bedrooms', 'condo', 'parking_spots', 'suites']
+    df[fill_cols] = df[fill_cols].fillna(0)
 
-        # Wait for next acquisition - 3 min
-        sleep(180)
+    # Drop address column
+    df = df.drop(['address'], axis=1)
 
-    # Join results dataframes
-    return join_dataframes("../../data/interim/Partial_nomatim_", n)
+    # Reset index again, with compact dtypes
+    return apply_schema(df.reset_index(drop=True))
 
 
 def join_dataframes(file_static, n, save=False):
@@ -134,13 +315,12 @@ def join_dataframes(file_static, n, save=False):
     df: pd.DataFrame
         Final combined DataFrame
     """
-    # Placeholder
-    df = pd.DataFrame()
-    # Read all files and append them together
+    # Read all files and concatenate them once
+    df_pieces = []
     for i in range(n):
-        df_piece = pd.read_csv(file_static + str(i) + ".csv")
-        df_piece = df_piece[(df_piece.lat != 0) & (df_piece.lon != 0)]
-        df = df.append(df_piece)
+        df_piece = read_table(file_static + str(i) + ".csv")
+        df_pieces.append(df_piece[(df_piece.lat != 0) & (df_piece.lon != 0)])
+    df = pd.concat(df_pieces)
 
     # Save result
     if save:
@@ -1,25 +1,61 @@
 """Add new features to the dataset"""
 # import click
+import logging
 import os
-import time
 
-import pandas as pd
+from ..data.formats import with_format
+from ..data.stage_cache import STAGE_CACHE_DIR
+from ..utils.instrument import instrumented
+from ..utils.utils import get_spinner
 
-from ..utils.utils import in_ipynb
-from .address_to_coordenates import apply_nomatin
-from .combine_features import combine_features
 
-if in_ipynb():
-    from halo import HaloNotebook as Halo
-else:
-    from halo import Halo
+def _geocode_stage(input_file, output_file, force, cache):
+    """
+    Entry of the geocoding of input_file in the stage cache, geocoded (and
+    saved to output_file) only if the input, the gazetteer or the code
+    changed since a cached run. A run where the API blocked some addresses
+    is not cached, so the next one retries them.
 
+    Returns
+    -------
+    entry: dict or None
+        Entry of the stage (see StageCache.get), None if the run was not cached
+    df: pd.DataFrame or None
+        Geocoded listings, None when the cached entry was used
+    """
+    from ..data import schema, storage
+    from ..data.formats import file_format
+    from ..data.storage import read_table, write_table
+    from . import address_to_coordenates, gazetteer, geocode_cache
+    from .address_to_coordenates import apply_nomatin, pending_addresses
+    from .gazetteer import GAZETTEER_PATH, load_gazetteer
+    from .geocode_cache import GEOCODE_CACHE_PATH, GeocodeCache
 
-# @click.option('--nomatin', type=click.BOOL, default=False,
-#               help='Wheather or not call the nomatin API to convert the addresses')
-def add_features(input_file, output_file, force):
-    """ Runs build features scripts to turn processed data from (../processed) into
-        improved data (saved in ../processed as well).
+    inputs = [input_file] + ([GAZETTEER_PATH] if os.path.exists(GAZETTEER_PATH) else [])
+    key = cache.key('geocode', inputs, {'format': file_format(output_file)},
+                    [address_to_coordenates, gazetteer, geocode_cache, schema, storage])
+    entry = None if force else cache.get('geocode', key)
+    if entry is not None:
+        return entry, None
+    listings = read_table(input_file)
+    df = apply_nomatin(listings, cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH)
+    write_table(df, output_file)
+
+    # Addresses still not resolved locally were blocked, not missing
+    pending = pending_addresses(listings['address'], GeocodeCache(GEOCODE_CACHE_PATH),
+                                load_gazetteer(GAZETTEER_PATH))
+    if pending:
+        logging.getLogger(__name__).warning(
+            '%d addresses were not geocoded, the geocoding is not cached', len(pending))
+        return None, df
+    return cache.put('geocode', key, {'output': output_file}), df
+
+
+@instrumented('features.add_coordinates')
+def add_coordinates(input_file, output_file, force, incremental=False, fmt=None,
+                    stage_cache=STAGE_CACHE_DIR):
+    """ Adds the latitude and longitude of the listings address to the processed
+        data (saved in ../processed as well).
 
         Parameters
         ----------
@@ -29,26 +65,109 @@ def add_features(input_file, output_file, force):
             Output processed file
         force: bool
             Force to process the input file
+        incremental: bool
+            Only process the listings whose fingerprint is not in the previous
+            output file and drop the ones no longer in the input file
+        fmt: str or None
+            Format of the output file ('csv', 'parquet' or 'feather'), None
+            keeps the extension of output_file
+        stage_cache: str
+            Folder of the stage cache, the input is geocoded again only if it,
+            the gazetteer or the code changed since a cached run (see StageCache)
     """
-    spinner = Halo(text='Building features...', spinner='dots')
+    from ..data.incremental import load_previous, merge_incremental
+    from ..data.stage_cache import StageCache
+    from ..data.storage import read_table, write_table
+    from .address_to_coordenates import apply_nomatin
+
+    spinner = get_spinner('Adding coordinates...')
 
-    clean_data = pd.read_csv(input_file)
+    output_file = with_format(output_file, fmt)
+
+    previous_data = load_previous(output_file) if incremental else None
+    clean_data = read_table(input_file) if previous_data is not None else None
+    if clean_data is not None and 'fingerprint' in clean_data.columns:
+        spinner.start("Adding coordinates to new listings")
+        new_data = clean_data[~clean_data['fingerprint'].isin(previous_data['fingerprint'])]
+        removed = previous_data['fingerprint'][~previous_data['fingerprint'].isin(clean_data['fingerprint'])]
+        new_data = apply_nomatin(new_data)
+        transformed_data = merge_incremental(previous_data, new_data, removed)
+        write_table(transformed_data, output_file)
+        spinner.succeed("Coordinates added to {} new listings!".format(len(new_data)))
+        return transformed_data
 
     # Add lat/lon columns
-    if force or not os.path.exists(output_file):
-        spinner.start("Adding Latitude and Longitude columns")
-        transformed_data = apply_nomatin(clean_data)
-        transformed_data.to_csv(output_file, index=False)
-        spinner.succeed("Latitude and Longitude features added!")
+    spinner.start("Adding Latitude and Longitude columns")
+    cache = StageCache(stage_cache)
+    entry, transformed_data = _geocode_stage(input_file, output_file, force, cache)
+    if transformed_data is None:
+        cache.restore(entry, {'output': output_file})
+        transformed_data = read_table(output_file)
+        spinner.stop_and_persist(text="Coordinates are up to date!")
     else:
-        spinner.start("Loading transformed file...")
-        time.sleep(2)
-        transformed_data = pd.read_csv(output_file)
-        spinner.stop_and_persist(text="Transformed file already exists!")
+        spinner.succeed("Latitude and Longitude features added!")
 
-    # Combine features
-    transformed_data = combine_features(transformed_data)
+    return transformed_data
+
+
+@instrumented('features.add_features')
+def add_features(input_file, output_file, force, incremental=False, fmt=None,
+                 stage_cache=STAGE_CACHE_DIR):
+    """ Runs build features scripts to turn processed data from (../processed) into
+        improved data (saved in ../processed as well).
 
-    transformed_data.to_csv(output_file, index=False)
+        Parameters
+        ----------
+        input_file: str
+            Input file to be processed
+        output_file: str
+            Output processed file
+        force: bool
+            Force to process the input file
+        incremental: bool
+            Only process the listings whose fingerprint is not in the previous
+            output file and drop the ones no longer in the input file
+        fmt: str or None
+            Format of the output file ('csv', 'parquet' or 'feather'), None
+            keeps the extension of output_file
+        stage_cache: str
+            Folder of the stage cache, the geocoding and the combined features
+            are computed again only if their inputs or code changed (see StageCache)
+    """
+    from ..data import schema, storage
+    from ..data.formats import file_format
+    from ..data.stage_cache import StageCache
+    from ..data.storage import read_table, write_table
+    from . import combine_features as combine_module, spatial_index
+    from .combine_features import combine_features
+
+    output_file = with_format(output_file, fmt)
+    if incremental:
+        transformed_data = add_coordinates(input_file, output_file, force, incremental, fmt,
+                                           stage_cache)
+        transformed_data = combine_features(transformed_data)
+        write_table(transformed_data, output_file)
+        return transformed_data
+
+    # Geocoded listings, from the cache when the clean data did not change
+    cache = StageCache(stage_cache)
+    geocoded, transformed_data = _geocode_stage(input_file, output_file, force, cache)
+
+    # Combine features, skipped when the geocoded listings did not change
+    if geocoded is None:
+        transformed_data = combine_features(transformed_data)
+        write_table(transformed_data, output_file)
+        return transformed_data
+    key = cache.key('features', params={'format': file_format(output_file)},
+                    code=[combine_module, spatial_index, schema, storage], upstream=[geocoded])
+    entry = cache.get('features', key)
+    if entry is not None:
+        cache.restore(entry, {'output': output_file})
+        return read_table(output_file)
+    if transformed_data is None:
+        transformed_data = read_table(cache.output_path(geocoded, 'output'))
+    transformed_data = combine_features(transformed_data)
+    write_table(transformed_data, output_file)
+    cache.put('features', key, {'output': output_file})
 
     return transformed_data
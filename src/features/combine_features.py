@@ -1,11 +1,169 @@
 """Specific data processing steps"""
+import warnings
 
+import numpy as np
 
-def combine_features(dataframe):
+from ..utils.instrument import instrumented
+
+# Reference points of Natal as (lat, lon), the beaches are approximate
+CITY_CENTRE = (-5.7945, -35.2110)
+BEACHES = {
+    'ponta_negra': (-5.8803, -35.1750),
+    'areia_preta': (-5.7935, -35.1862),
+    'praia_do_meio': (-5.7790, -35.1960),
+    'redinha': (-5.7440, -35.2050),
+}
+
+# Rows of each block of the vectorized distance computations
+BLOCK_SIZE = 100000
+
+
+def distance_to_points(lat, lon, points, block_size=BLOCK_SIZE):
+    """
+    Distance in meters from each listing to the nearest of some points,
+    computed by broadcasting in blocks of listings.
+
+    Parameters
+    ----------
+    lat, lon: array-like
+        Coordinates of the listings, in degrees
+    points: list
+        (lat, lon) of the points, in degrees
+    block_size: int
+        Listings of each block
+
+    Returns
+    -------
+    distances: np.ndarray
+        Distance to the nearest point, NaN for listings without coordinates
     """
+    from .spatial_index import haversine
+
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    points = np.asarray(points, dtype='float64')
+    distances = np.empty(len(lat))
+    for start in range(0, len(lat), block_size):
+        block = slice(start, start + block_size)
+        distances[block] = haversine(lat[block, None], lon[block, None],
+                                     points[None, :, 0], points[None, :, 1]).min(axis=1)
+    return distances
+
+
+@instrumented('features.neighbourhood')
+def neighbourhood_features(df, reference=None, k=10, radii=(500, 1000), block_size=BLOCK_SIZE):
+    """
+    Aggregates of the listings around each listing: the median price per m²
+    of its k nearest neighbours and the (approximate, see SpatialIndex.density)
+    number of listings within each radius.
+    When the listings are their own reference, each one is left out of its
+    own aggregates so its price does not leak into its features.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Listings with 'lat' and 'lon'
+    reference: pd.DataFrame or None
+        Listings with 'lat', 'lon', 'price' and 'area' the aggregates come
+        from, None uses df itself (leave-one-out)
+    k: int
+        Number of neighbours of the median price per m²
+    radii: tuple
+        Radii in meters of the densities
+    block_size: int
+        Listings queried at once
+
+    Returns
+    -------
+    features: dict
+        Column name -> np.ndarray, 'price_per_area_knn' and 'density_<r>m'
+    """
+    from .spatial_index import SpatialIndex
+
+    leave_one_out = reference is None
+    reference = df if reference is None else reference
+    lat = df['lat'].to_numpy(dtype='float64', na_value=np.nan)
+    lon = df['lon'].to_numpy(dtype='float64', na_value=np.nan)
+    price = reference['price'].to_numpy(dtype='float64', na_value=np.nan)
+    area = reference['area'].to_numpy(dtype='float64', na_value=np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price_per_area = np.where(area > 0, price / area, np.nan)
+
+    index = SpatialIndex.from_dataframe(reference)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    rows = np.flatnonzero(valid)
+    median = np.full(len(df), np.nan)
+    densities = {r: np.zeros(len(df), dtype='int64') for r in radii}
+    k = min(k, len(index) - leave_one_out)
+    if k <= 0 or len(rows) == 0:
+        return {'price_per_area_knn': median,
+                **{'density_{}m'.format(r): d for r, d in densities.items()}}
+
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        _, neighbours = index.query_knn(lat[block], lon[block], k + leave_one_out)
+        values = price_per_area[neighbours]
+        if leave_one_out:
+            # Drop the listing itself, or the farthest neighbour when the
+            # listing is not among them (ties at the same coordinates)
+            is_self = neighbours == block[:, None]
+            values[is_self] = np.nan
+            values[~is_self.any(axis=1), -1] = np.nan
+        with warnings.catch_warnings():
+            # Listings whose neighbours have no price per m² stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median[block] = np.nanmedian(values, axis=1)
+
+    # Densities of the whole set at once, approximated on a grid
+    for r in radii:
+        densities[r][rows] = index.density(lat[rows], lon[rows], r) - leave_one_out
+
+    return {'price_per_area_knn': median,
+            **{'density_{}m'.format(r): d for r, d in densities.items()}}
+
+
+@instrumented('features.combine')
+def combine_features(dataframe, neighbourhood=True, reference=None, k=10, radii=(500, 1000)):
+    """
+    Add the combined features of the listings: bedrooms per area and, for
+    listings with coordinates, the distances to the city centre and to the
+    nearest beach and the neighbourhood aggregates (see neighbourhood_features).
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Listings
+    neighbourhood: bool
+        Add the neighbourhood aggregates, which need the other listings
+    reference: pd.DataFrame or None
+        Listings the neighbourhood aggregates come from, None uses dataframe
+        itself leaving each listing out of its own aggregates
+    k: int
+        Number of neighbours of the median price per m²
+    radii: tuple
+        Radii in meters of the densities
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Listings with the combined features
     """
     df = dataframe.copy()
     # attribute combinations
     df["bedrooms_per_area"] = df["bedrooms"] / df["area"]
 
+    if 'lat' not in df.columns or 'lon' not in df.columns:
+        return df
+
+    # Distances, in km
+    lat = df['lat'].to_numpy(dtype='float64', na_value=np.nan)
+    lon = df['lon'].to_numpy(dtype='float64', na_value=np.nan)
+    df['distance_to_centre'] = distance_to_points(lat, lon, [CITY_CENTRE]) / 1000
+    df['distance_to_beach'] = distance_to_points(lat, lon, list(BEACHES.values())) / 1000
+
+    # Neighbourhood aggregates
+    if neighbourhood and (reference is not None or 'price' in df.columns):
+        for col, values in neighbourhood_features(df, reference, k, radii).items():
+            df[col] = values
+
     return df
@@ -0,0 +1,268 @@
+"""Offline geocoding of addresses from a local index of streets and neighbourhoods"""
+import difflib
+import io
+import logging
+import os
+import re
+import unicodedata
+
+import pandas as pd
+
+# Gazetteer of the pipeline, built from the geocoding cache by update_gazetteer
+GAZETTEER_PATH = './references/gazetteer_natal.csv'
+
+# Abbreviations of street types expanded before matching
+ABBREVIATIONS = {'av': 'avenida', 'r': 'rua', 'al': 'alameda', 'tv': 'travessa',
+                 'trav': 'travessa', 'pca': 'praca', 'rod': 'rodovia', 'estr': 'estrada'}
+
+
+def normalize_name(name):
+    """
+    Normalize a street or neighbourhood name: lower case, no accents, no
+    punctuation, single spaces and expanded street type abbreviations.
+
+    Parameters
+    ----------
+    name: str
+        Street or neighbourhood name
+
+    Returns
+    -------
+    key: str
+        Normalized name
+    """
+    key = unicodedata.normalize('NFKD', str(name))
+    key = ''.join(c for c in key if not unicodedata.combining(c)).lower()
+    words = re.sub(r'[^\w\s]', ' ', key).split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def parse_address(address):
+    """
+    Split an address as written in the listings ('Rua X, 123 - Bairro, Natal - RN',
+    'Rua X - Bairro, Natal - RN' or 'Bairro, Natal - RN') in its street and neighbourhood.
+
+    Parameters
+    ----------
+    address: str
+        String with the address
+
+    Returns
+    -------
+    street: str or None
+        Normalized street name, None if the address has no street
+    neighbourhood: str or None
+        Normalized neighbourhood name, None if it could not be parsed
+    """
+    # Drop the trailing 'City - UF'
+    match = re.match(r'^(.*?),\s*[^,]+?\s*-\s*[A-Za-z]{2}\s*$', str(address).strip())
+    if match is None:
+        return None, None
+    head = match.group(1)
+
+    # Also accepts the 'street- neighbourhood' of normalized addresses
+    parts = re.split(r'\s*-\s+', head)
+    if len(parts) > 1:
+        street, neighbourhood = ' '.join(parts[:-1]), parts[-1]
+        street = normalize_name(street.split(',')[0]) or None
+    else:
+        street, neighbourhood = None, head
+    return street, normalize_name(neighbourhood) or None
+
+
+class Gazetteer:
+    """
+    In-memory index of the coordinates of streets and neighbourhoods.
+
+    Parameters
+    ----------
+    entries: pd.DataFrame
+        One row per place with the columns 'kind' ('street' or
+        'neighbourhood'), 'name', 'neighbourhood' (of the street, may be
+        empty), 'lat' and 'lon'.
+    cutoff: float
+        Minimum similarity (0 to 1) of a fuzzy name match.
+    """
+
+    def __init__(self, entries, cutoff=.85):
+        self.cutoff = cutoff
+        self.streets = {}              # (street, neighbourhood) -> coords
+        self.streets_any = {}          # street -> coords
+        self.neighbourhoods = {}       # neighbourhood -> coords
+        self.streets_by_neighbourhood = {}
+
+        for kind, name, neighbourhood, lat, lon in entries[
+                ['kind', 'name', 'neighbourhood', 'lat', 'lon']].itertuples(index=False):
+            name = normalize_name(name)
+            neighbourhood = normalize_name(neighbourhood) if isinstance(neighbourhood, str) else None
+            if kind == 'neighbourhood':
+                self.neighbourhoods[name] = (lat, lon)
+            elif neighbourhood:
+                self.streets[(name, neighbourhood)] = (lat, lon)
+                self.streets_by_neighbourhood.setdefault(neighbourhood, []).append(name)
+                self.streets_any.setdefault(name, (lat, lon))
+            else:
+                self.streets_any[name] = (lat, lon)
+        self._street_names = list(self.streets_any)
+        self._neighbourhood_names = list(self.neighbourhoods)
+
+    @classmethod
+    def from_csv(cls, path, cutoff=.85):
+        """
+        Load the gazetteer from a .csv file with the columns described in Gazetteer.
+        """
+        return cls(pd.read_csv(path), cutoff)
+
+    def _closest(self, name, candidates):
+        match = difflib.get_close_matches(name, candidates, n=1, cutoff=self.cutoff)
+        return match[0] if match else None
+
+    def _neighbourhood(self, neighbourhood):
+        if neighbourhood is not None and neighbourhood not in self.neighbourhoods:
+            return self._closest(neighbourhood, self._neighbourhood_names) or neighbourhood
+        return neighbourhood
+
+    def centroid(self, address):
+        """
+        Coordinates of the neighbourhood of an address, None if it is not known.
+        """
+        return self.neighbourhoods.get(self._neighbourhood(parse_address(address)[1]))
+
+    def lookup(self, address):
+        """
+        Coordinates of an address, matching its street inside its
+        neighbourhood and then its street anywhere. Names are matched exactly
+        first and fuzzily after. Addresses without a street are placed at
+        their neighbourhood, the others are left to the API when their street
+        is not known (see centroid for the fallback).
+
+        Parameters
+        ----------
+        address: str
+            String with the address
+
+        Returns
+        -------
+        coords: tuple or None
+            (lat, lon) of the address, None if it was not found
+        """
+        street, neighbourhood = parse_address(address)
+        neighbourhood = self._neighbourhood(neighbourhood)
+        if street is None:
+            return self.neighbourhoods.get(neighbourhood)
+
+        # Street inside its neighbourhood
+        if (street, neighbourhood) in self.streets:
+            return self.streets[(street, neighbourhood)]
+        match = self._closest(street, self.streets_by_neighbourhood.get(neighbourhood, []))
+        if match is not None:
+            return self.streets[(match, neighbourhood)]
+        # Street anywhere
+        if street in self.streets_any:
+            return self.streets_any[street]
+        match = self._closest(street, self._street_names)
+        if match is not None:
+            return self.streets_any[match]
+        return None
+
+
+def build_gazetteer(addresses, lat, lon):
+    """
+    Build gazetteer entries from addresses with known coordinates (e.g. the
+    geocoding cache): the median position of each street of each
+    neighbourhood and of each neighbourhood.
+
+    Parameters
+    ----------
+    addresses: iterable
+        Strings with the addresses
+    lat: iterable
+        Latitude of each address
+    lon: iterable
+        Longitude of each address
+
+    Returns
+    -------
+    entries: pd.DataFrame
+        Entries as expected by Gazetteer, ready to be saved with to_csv.
+    """
+    parsed = [parse_address(address) for address in addresses]
+    df = pd.DataFrame({'name': [p[0] for p in parsed], 'neighbourhood': [p[1] for p in parsed],
+                       'lat': list(lat), 'lon': list(lon)})
+    # Only found places
+    df = df[(df.lat != 0) & (df.lon != 0)].dropna(subset=['lat', 'lon', 'neighbourhood'])
+
+    streets = df.dropna(subset=['name']).groupby(['name', 'neighbourhood'], as_index=False)[
+        ['lat', 'lon']].median()
+    streets['kind'] = 'street'
+    neighbourhoods = df.groupby('neighbourhood', as_index=False)[['lat', 'lon']].median()
+    neighbourhoods['name'] = neighbourhoods['neighbourhood']
+    neighbourhoods['neighbourhood'] = None
+    neighbourhoods['kind'] = 'neighbourhood'
+
+    columns = ['kind', 'name', 'neighbourhood', 'lat', 'lon']
+    return pd.concat([neighbourhoods[columns], streets[columns]], ignore_index=True)
+
+
+def load_gazetteer(path=GAZETTEER_PATH, cutoff=.85):
+    """
+    Gazetteer saved in path, None (with a warning) if it was not built yet.
+    """
+    if path is None:
+        return None
+    if not os.path.exists(path):
+        logging.getLogger(__name__).warning(
+            'Gazetteer %s not found, every address not cached goes to the API '
+            '(build it with the gazetteer stage)', path)
+        return None
+    return Gazetteer.from_csv(path, cutoff)
+
+
+def update_gazetteer(cache_path='./data/external/geocode_cache.sqlite',
+                     gazetteer_path=GAZETTEER_PATH):
+    """
+    Build the gazetteer from every place already geocoded by the API, saving
+    it only if it changed.
+
+    Parameters
+    ----------
+    cache_path: str
+        Path of the geocoding cache database
+    gazetteer_path: str
+        Path of the .csv gazetteer
+
+    Returns
+    -------
+    places: int
+        Number of places of the gazetteer, 0 if the cache is empty
+    """
+    from .geocode_cache import GeocodeCache
+
+    logger = logging.getLogger(__name__)
+    if not os.path.exists(cache_path):
+        logger.warning('Geocoding cache %s not found, the gazetteer can not be built yet', cache_path)
+        return 0
+    cached = GeocodeCache(cache_path).items()
+    gazetteer = build_gazetteer(cached['address'], cached['lat'], cached['lon'])
+    if gazetteer.empty:
+        logger.warning('No place geocoded in %s, the gazetteer can not be built yet', cache_path)
+        return 0
+
+    # Written only when it changed, so the stages using it are not invalidated
+    buffer = io.StringIO()
+    gazetteer.to_csv(buffer, index=False)
+    content = buffer.getvalue()
+    if os.path.exists(gazetteer_path):
+        with open(gazetteer_path, encoding='utf-8') as f:
+            if f.read() == content:
+                return len(gazetteer)
+    os.makedirs(os.path.dirname(gazetteer_path) or '.', exist_ok=True)
+    with open(gazetteer_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    logger.info('Gazetteer of %d places saved in %s', len(gazetteer), gazetteer_path)
+    return len(gazetteer)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print("{} places saved".format(update_gazetteer()))
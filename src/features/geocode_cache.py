@@ -0,0 +1,110 @@
+"""Persistent cache of the coordinates found for each address"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import pandas as pd
+
+# Geocoding cache of the pipeline
+GEOCODE_CACHE_PATH = './data/external/geocode_cache.sqlite'
+
+
+def normalize_address(address):
+    """
+    Normalize an address so the same place written differently shares the
+    cache entry: lower case, no accents, single spaces and no spaces
+    around punctuation.
+
+    Parameters
+    ----------
+    address: str
+        String with the address
+
+    Returns
+    -------
+    key: str
+        Normalized address
+    """
+    key = unicodedata.normalize('NFKD', str(address))
+    key = ''.join(c for c in key if not unicodedata.combining(c)).lower()
+    key = re.sub(r'\s+', ' ', key)
+    key = re.sub(r'\s*([,-])\s*', r'\1 ', key)
+    return key.strip(' ,-')
+
+
+class GeocodeCache:
+    """
+    SQLite table of (normalized address -> lat, lon). Addresses that the API
+    could not find are stored with lat = lon = 0, as address2coord returns.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite database. ':memory:' keeps the cache in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS geocode ("
+                               "address TEXT PRIMARY KEY, lat REAL, lon REAL, updated REAL)")
+
+    def get_many(self, keys):
+        """
+        Coordinates of the cached addresses.
+
+        Parameters
+        ----------
+        keys: iterable
+            Normalized addresses.
+
+        Returns
+        -------
+        found: dict
+            Normalized address -> (lat, lon), only for the cached ones.
+        """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a query
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    "SELECT address, lat, lon FROM geocode WHERE address IN ({})"
+                    .format(','.join('?' * len(batch))), batch)
+                found.update((address, (lat, lon)) for address, lat, lon in rows)
+        return found
+
+    def put(self, key, lat, lon):
+        """
+        Save the coordinates of a normalized address.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)",
+                               (key, lat, lon, time.time()))
+
+    def items(self):
+        """
+        All the cached entries.
+
+        Returns
+        -------
+        df: pd.DataFrame
+            Columns 'address' (normalized), 'lat' and 'lon'.
+        """
+        with self._lock:
+            return pd.read_sql_query("SELECT address, lat, lon FROM geocode", self._conn)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
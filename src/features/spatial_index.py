@@ -0,0 +1,259 @@
+"""Spatial index of the listings for radius, nearest-neighbour and bounding box queries"""
+import os
+
+import numpy as np
+
+# Mean radius of the Earth, in meters
+EARTH_RADIUS = 6371008.8
+
+# Changes when the persisted index changes, so older files are rebuilt
+INDEX_VERSION = 2
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in meters between points given in degrees, with
+    numpy broadcasting between the arrays.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype='float64'))
+                              for x in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    """
+    KD tree of the listings coordinates projected to meters, with the
+    latitudes also sorted for bounding box queries. Listings without
+    coordinates are left out, and the queries return positions (iloc) of
+    the rows of the DataFrame the index was built from.
+    OBS.: the projection is equirectangular around the mean latitude, at the
+    scale of a city it distorts distances by less than 0.1% and it is much
+    faster to query than a ball tree on the haversine distance.
+
+    Parameters
+    ----------
+    lat: array-like
+        Latitude of each listing, in degrees
+    lon: array-like
+        Longitude of each listing, in degrees
+    leaf_size: int
+        Leaf size of the KD tree
+    """
+
+    def __init__(self, lat, lon, leaf_size=40):
+        from sklearn.neighbors import KDTree
+
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        self.positions = np.flatnonzero(valid)
+        self.lat = lat[valid]
+        self.lon = lon[valid]
+        self.cos_lat = np.cos(np.radians(self.lat.mean())) if len(self.lat) else 1.
+        self.tree = KDTree(self._points(self.lat, self.lon), leaf_size=leaf_size)
+        self._lat_order = np.argsort(self.lat, kind='stable')
+        self._sorted_lat = self.lat[self._lat_order]
+        self.signature = None
+
+    @classmethod
+    def from_dataframe(cls, df, leaf_size=40):
+        """
+        Index of the 'lat' and 'lon' columns of a DataFrame.
+        """
+        return cls(df['lat'].astype('float64'), df['lon'].astype('float64'), leaf_size)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _points(self, lat, lon):
+        lat = np.radians(np.atleast_1d(lat).astype('float64'))
+        lon = np.radians(np.atleast_1d(lon).astype('float64'))
+        return np.column_stack([lon * self.cos_lat, lat]) * EARTH_RADIUS
+
+    def query_radius(self, lat, lon, radius, return_distance=False):
+        """
+        Listings within radius meters of each point.
+
+        Parameters
+        ----------
+        lat, lon: float or array-like
+            Coordinates of the points, in degrees
+        radius: float
+            Distance in meters
+        return_distance: bool
+            Also return the distances, the listings are then sorted by distance
+
+        Returns
+        -------
+        positions: np.ndarray or list
+            Positions of the listings near the point (one array per point when
+            arrays of coordinates are given)
+        distances: np.ndarray or list
+            Distances in meters, only if return_distance
+        """
+        points = self._points(lat, lon)
+        result = self.tree.query_radius(points, radius, return_distance=return_distance,
+                                        sort_results=return_distance)
+        if return_distance:
+            ind, distances = result
+            positions = [self.positions[i] for i in ind]
+            if np.ndim(lat) == 0:
+                return positions[0], distances[0]
+            return positions, distances
+        positions = [self.positions[i] for i in result]
+        return positions[0] if np.ndim(lat) == 0 else positions
+
+    def count_radius(self, lat, lon, radius):
+        """
+        Number of listings within radius meters of each point.
+        """
+        counts = self.tree.query_radius(self._points(lat, lon), radius, count_only=True)
+        return counts[0] if np.ndim(lat) == 0 else counts
+
+    def density(self, lat, lon, radius, resolution=32, max_cells=5e7):
+        """
+        Approximate number of listings within radius meters of each point:
+        the listings are counted in a grid of cells of radius / resolution
+        meters, convolved with a disc of the radius. Counts are within a few
+        percent of count_radius, at a fraction of its cost for large radii.
+
+        Parameters
+        ----------
+        lat, lon: array-like
+            Coordinates of the points, in degrees
+        radius: float
+            Distance in meters
+        resolution: int
+            Cells per radius
+        max_cells: float
+            Largest grid, when the listings are too spread out the exact
+            count_radius is used instead
+
+        Returns
+        -------
+        counts: int or np.ndarray
+            Number of listings near each point
+        """
+        from scipy.signal import fftconvolve
+
+        points = self._points(lat, lon)
+        listings = np.asarray(self.tree.data)
+        cell = radius / resolution
+        low = np.minimum(points.min(axis=0), listings.min(axis=0))
+        shape = ((np.maximum(points.max(axis=0), listings.max(axis=0)) - low) // cell).astype(int) + 1
+        if shape[0] * shape[1] > max_cells:
+            return self.count_radius(lat, lon, radius)
+
+        # Listings per cell
+        cells = ((listings - low) // cell).astype(int)
+        grid = np.bincount(cells[:, 0] * shape[1] + cells[:, 1], minlength=shape[0] * shape[1])
+        grid = grid.reshape(shape).astype('float64')
+
+        # Sum of the cells within the radius of each cell
+        offsets = np.arange(-resolution, resolution + 1)
+        disc = (offsets[:, None] ** 2 + offsets[None, :] ** 2 <= resolution ** 2).astype('float64')
+        counts = np.rint(fftconvolve(grid, disc, mode='same')).astype('int64')
+
+        cells = ((points - low) // cell).astype(int)
+        counts = counts[cells[:, 0], cells[:, 1]]
+        return counts[0] if np.ndim(lat) == 0 else counts
+
+    def query_knn(self, lat, lon, k=10):
+        """
+        The k listings nearest to each point, sorted by distance.
+
+        Parameters
+        ----------
+        lat, lon: float or array-like
+            Coordinates of the points, in degrees
+        k: int
+            Number of neighbours
+
+        Returns
+        -------
+        distances: np.ndarray
+            Distances in meters, shape (k,) or (n_points, k)
+        positions: np.ndarray
+            Positions of the neighbours, same shape as distances
+        """
+        dist, ind = self.tree.query(self._points(lat, lon), k=min(k, len(self)))
+        positions = self.positions[ind]
+        if np.ndim(lat) == 0:
+            return dist[0], positions[0]
+        return dist, positions
+
+    def query_bbox(self, south, west, north, east):
+        """
+        Listings inside a bounding box, given by its limits in degrees.
+
+        Returns
+        -------
+        positions: np.ndarray
+            Positions of the listings inside the box, in ascending order
+        """
+        start = np.searchsorted(self._sorted_lat, south, side='left')
+        stop = np.searchsorted(self._sorted_lat, north, side='right')
+        candidates = self._lat_order[start:stop]
+        lon = self.lon[candidates]
+        inside = candidates[(lon >= west) & (lon <= east)]
+        return np.sort(self.positions[inside])
+
+    def save(self, path):
+        """
+        Persist the index with joblib.
+        """
+        import joblib
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        import joblib
+        return joblib.load(path)
+
+
+def index_path(data_file):
+    """
+    Path where the index of data_file is persisted, next to it.
+    """
+    return os.path.splitext(data_file)[0] + '.spatial.joblib'
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, INDEX_VERSION)
+
+
+def load_index(data_file, force=False, leaf_size=40):
+    """
+    Spatial index of the listings of a dataset, loaded from the file next
+    to it when it is still up to date, otherwise built and persisted.
+
+    Parameters
+    ----------
+    data_file: str
+        Dataset with 'lat' and 'lon' columns (.csv, .parquet or .feather)
+    force: bool
+        Build the index even if an up to date one exists
+    leaf_size: int
+        Leaf size of the KD tree
+
+    Returns
+    -------
+    index: SpatialIndex
+        Index of the rows of data_file
+    """
+    from ..data.storage import read_table
+
+    path = index_path(data_file)
+    signature = _file_signature(data_file)
+    if not force and os.path.exists(path):
+        index = SpatialIndex.load(path)
+        if index.signature == signature:
+            return index
+
+    index = SpatialIndex.from_dataframe(read_table(data_file, columns=['lat', 'lon']), leaf_size)
+    index.signature = signature
+    index.save(path)
+    return index
@@ -0,0 +1,247 @@
+"""Prices listings with the trained model"""
+import itertools
+import os
+from functools import lru_cache
+
+from ..features.gazetteer import GAZETTEER_PATH
+from ..features.geocode_cache import GEOCODE_CACHE_PATH
+from ..utils.instrument import span
+from .train_model import latest_model, prepare_features
+
+PREDICTION_COL = 'predicted_price'
+
+
+def load_model(model_path=None, model_dir='./models'):
+    """
+    Load a trained model, kept in memory so later calls do not read it again
+    (unless the file changes).
+
+    Parameters
+    ----------
+    model_path: str or None
+        Path of the .joblib model, None loads the latest one in model_dir
+    model_dir: str
+        Folder of the versioned models
+
+    Returns
+    -------
+    model: sklearn.pipeline.Pipeline
+        Fitted model
+    """
+    if model_path is None:
+        model_path = latest_model(model_dir)
+        if model_path is None:
+            raise FileNotFoundError("No trained model in {}".format(model_dir))
+    return _load_model(os.path.abspath(model_path), os.path.getmtime(model_path))
+
+
+@lru_cache(maxsize=4)
+def _load_model(model_path, mtime):
+    import joblib
+    return joblib.load(model_path)
+
+
+def load_geocoder(cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH):
+    """
+    Geocoding cache and gazetteer, kept in memory so later calls do not read
+    them again (unless the gazetteer is built or rebuilt).
+
+    Returns
+    -------
+    cache: GeocodeCache or None
+        Cache of the coordinates already found
+    gazetteer: Gazetteer or None
+        Local index of streets and neighbourhoods, None if it does not exist
+    """
+    mtime = None
+    if gazetteer_path is not None and os.path.exists(gazetteer_path):
+        mtime = os.path.getmtime(gazetteer_path)
+    return _load_geocoder(cache_path, gazetteer_path, mtime)
+
+
+@lru_cache(maxsize=4)
+def _load_geocoder(cache_path, gazetteer_path, mtime):
+    from ..features.gazetteer import load_gazetteer
+    from ..features.geocode_cache import GeocodeCache
+
+    cache = GeocodeCache(cache_path) if cache_path is not None else None
+    return cache, load_gazetteer(gazetteer_path)
+
+
+def fill_coordinates(df, cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH,
+                     api=True):
+    """
+    Geocode the address of the listings without 'lat' and 'lon', with the
+    same cache and gazetteer as apply_nomatin. Addresses not found are left
+    as NaN and imputed by the model.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Listings with an 'address' column
+    cache_path: str or None
+        Path of the geocoding cache database, None to always call the API
+    gazetteer_path: str or None
+        Path of the .csv gazetteer of streets and neighbourhoods, used if it exists
+    api: bool
+        Send the addresses not found locally to the geocoding API, otherwise
+        they are left as NaN
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Listings with the 'lat' and 'lon' columns
+    """
+    import numpy as np
+    from ..features.address_to_coordenates import geocode_batch
+
+    df = df.copy()
+    for col in ('lat', 'lon'):
+        df[col] = df[col].astype('float64') if col in df.columns else np.nan
+    missing = df['lat'].isna() | df['lon'].isna()
+    if missing.any():
+        cache, gazetteer = load_geocoder(cache_path, gazetteer_path)
+        coords = geocode_batch(df.loc[missing, 'address'], cache, gazetteer, api=api)
+        coords = coords.where(coords != 0)
+        df.loc[missing, 'lat'] = coords['lat'].values
+        df.loc[missing, 'lon'] = coords['lon'].values
+    return df
+
+
+def iter_batches(listings, chunksize=100000):
+    """
+    Split the listings in DataFrames of at most chunksize rows.
+
+    Parameters
+    ----------
+    listings: pd.DataFrame, dict, str or iterable
+        A DataFrame, a single listing as a dict, a .csv/.parquet/.feather
+        file (read in chunks) or an iterable of dicts
+    chunksize: int
+        Maximum number of listings of each batch
+
+    Yields
+    ------
+    df: pd.DataFrame
+        Batch of listings
+    """
+    import pandas as pd
+    from ..data.storage import iter_table
+
+    if isinstance(listings, pd.DataFrame):
+        for start in range(0, len(listings), chunksize):
+            yield listings.iloc[start:start + chunksize]
+    elif isinstance(listings, dict):
+        yield pd.DataFrame([listings])
+    elif isinstance(listings, str):
+        yield from iter_table(listings, chunksize)
+    else:
+        listings = iter(listings)
+        while True:
+            batch = list(itertools.islice(listings, chunksize))
+            if not batch:
+                break
+            yield pd.DataFrame(batch)
+
+
+def iter_predict(listings, model=None, chunksize=100000, geocode=True, model_dir='./models'):
+    """
+    Price the listings batch by batch, so memory is bounded by chunksize.
+
+    Parameters
+    ----------
+    listings: pd.DataFrame, dict, str or iterable
+        Listings as accepted by iter_batches
+    model: sklearn.pipeline.Pipeline, str or None
+        Fitted model or its path, None uses the latest one in model_dir
+    chunksize: int
+        Maximum number of listings priced at once
+    geocode: bool
+        Geocode the listings without coordinates from their 'address'
+    model_dir: str
+        Folder of the versioned models
+
+    Yields
+    ------
+    df: pd.DataFrame
+        Batch of listings with the PREDICTION_COL column
+    """
+    if model is None or isinstance(model, str):
+        model = load_model(model, model_dir)
+    for batch in iter_batches(listings, chunksize):
+        if geocode and 'address' in batch.columns:
+            batch = fill_coordinates(batch)
+        with span('model.predict', rows_in=len(batch), rows_out=len(batch)):
+            batch = batch.assign(**{PREDICTION_COL: model.predict(prepare_features(batch))})
+        yield batch
+
+
+def predict(listings, model=None, chunksize=100000, geocode=True, model_dir='./models'):
+    """
+    Predicted price of the listings.
+
+    Parameters
+    ----------
+    listings: pd.DataFrame, dict, str or iterable
+        Listings as accepted by iter_batches
+    model: sklearn.pipeline.Pipeline, str or None
+        Fitted model or its path, None uses the latest one in model_dir
+    chunksize: int
+        Maximum number of listings priced at once
+    geocode: bool
+        Geocode the listings without coordinates from their 'address'
+    model_dir: str
+        Folder of the versioned models
+
+    Returns
+    -------
+    prices: float or pd.Series
+        Price of a single listing (dict) or of each listing, indexed as the
+        DataFrame given (from 0 otherwise)
+    """
+    import pandas as pd
+
+    batches = [batch[PREDICTION_COL]
+               for batch in iter_predict(listings, model, chunksize, geocode, model_dir)]
+    if isinstance(listings, dict):
+        return float(batches[0].iloc[0])
+    if not batches:
+        return pd.Series([], name=PREDICTION_COL, dtype='float64')
+    prices = pd.concat(batches)
+    if not isinstance(listings, pd.DataFrame):
+        prices = prices.reset_index(drop=True)
+    return prices
+
+
+def predict_file(input_file, output_file, model=None, chunksize=100000, geocode=True,
+                 model_dir='./models'):
+    """
+    Price the listings of a file that may not fit in memory, writing them
+    with their PREDICTION_COL chunk by chunk.
+
+    Parameters
+    ----------
+    input_file: str
+        Listings (.csv, .parquet or .feather)
+    output_file: str
+        Listings with the predicted price (.csv, .parquet or .feather)
+    model: sklearn.pipeline.Pipeline, str or None
+        Fitted model or its path, None uses the latest one in model_dir
+    chunksize: int
+        Maximum number of listings priced at once
+    geocode: bool
+        Geocode the listings without coordinates from their 'address'
+    model_dir: str
+        Folder of the versioned models
+
+    Returns
+    -------
+    rows: int
+        Number of listings priced
+    """
+    from ..data.storage import TableWriter
+
+    with TableWriter(output_file) as writer:
+        for batch in iter_predict(input_file, model, chunksize, geocode, model_dir):
+            writer.write(batch)
+    return writer.rows
@@ -0,0 +1,327 @@
+"""Local HTTP service estimating the price of listings"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+from ..features.gazetteer import GAZETTEER_PATH
+from ..features.geocode_cache import GEOCODE_CACHE_PATH
+from .train_model import CATEGORICAL_FEATURES, COMBINED_FEATURES, NUMERIC_FEATURES
+
+# Fields of a listing, the missing ones are imputed by the model
+NUMBER_FIELDS = [col for col in NUMERIC_FEATURES if col not in COMBINED_FEATURES]
+TEXT_FIELDS = CATEGORICAL_FEATURES + ['address']
+
+
+def validate_listing(listing):
+    """
+    Check the type of the known fields of a listing, raising ValueError
+    naming the first invalid one.
+
+    Parameters
+    ----------
+    listing: dict
+        Listing sent to the service
+    """
+    for field in NUMBER_FIELDS:
+        value = listing.get(field)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("Field '{}' must be a number".format(field))
+        try:
+            float(value)
+        except ValueError:
+            raise ValueError("Field '{}' must be a number, got {!r}".format(field, value))
+    for field in TEXT_FIELDS:
+        if listing.get(field) is not None and not isinstance(listing[field], str):
+            raise ValueError("Field '{}' must be a string".format(field))
+
+
+class LRUCache:
+    """
+    Thread-safe cache of the most recently used prices.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries kept
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Cached value of key, None if it is not cached.
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MicroBatcher:
+    """
+    Coalesces the listings submitted by concurrent requests, so each batch
+    is priced with a single vectorized model call. A batch is sent when it
+    has max_batch listings or max_wait seconds after its first listing.
+
+    Parameters
+    ----------
+    model: sklearn.pipeline.Pipeline
+        Fitted model
+    max_batch: int
+        Maximum number of listings priced at once
+    max_wait: float
+        Seconds the first listing of a batch waits for others
+    """
+
+    def __init__(self, model, max_batch=256, max_wait=.005):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, listing):
+        """
+        Queue a listing to be priced.
+
+        Returns
+        -------
+        future: concurrent.futures.Future
+            Future with the price of the listing
+        """
+        future = Future()
+        self._queue.put((listing, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        from .predict_model import predict
+
+        while True:
+            batch = self._collect()
+            listings = [listing for listing, _ in batch]
+            # Located by the request handlers, the API is never waited for here
+            try:
+                prices = predict(listings, self.model, chunksize=len(listings), geocode=False)
+            except Exception:
+                # An invalid listing fails the batch, price them one by one
+                prices = None
+            self.batches += 1
+            for i, (listing, future) in enumerate(batch):
+                if prices is not None:
+                    future.set_result(float(prices[i]))
+                    continue
+                try:
+                    future.set_result(predict(listing, self.model, geocode=False))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+class PriceService(ThreadingHTTPServer):
+    """
+    HTTP server answering POST /predict with the price of the listing (a
+    JSON object) or listings (a JSON list) in the body, and GET /health.
+
+    Parameters
+    ----------
+    address: tuple
+        (host, port) where the service listens, port 0 picks a free one
+    model: sklearn.pipeline.Pipeline, str or None
+        Fitted model or its path, None uses the latest one in model_dir
+    model_dir: str
+        Folder of the versioned models
+    cache_size: int
+        Number of distinct listings whose price is kept
+    max_batch: int
+        Maximum number of listings priced at once
+    max_wait: float
+        Seconds the first listing of a batch waits for others
+    timeout: float
+        Seconds a request waits for its price
+    cache_path: str or None
+        Path of the geocoding cache database the addresses are located with
+    gazetteer_path: str or None
+        Path of the .csv gazetteer the addresses are located with
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 8000), model=None, model_dir='./models',
+                 cache_size=10000, max_batch=256, max_wait=.005, timeout=30.,
+                 cache_path=GEOCODE_CACHE_PATH, gazetteer_path=GAZETTEER_PATH):
+        from .predict_model import load_model
+
+        if model is None or isinstance(model, str):
+            model = load_model(model, model_dir)
+        self.cache = LRUCache(cache_size)
+        self.batcher = MicroBatcher(model, max_batch, max_wait)
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.gazetteer_path = gazetteer_path
+        super().__init__(address, PriceHandler)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def locate(self, listings):
+        """
+        Listings with the coordinates of their address, found in the geocoding
+        cache or the gazetteer only: the API is too slow to be waited for by a
+        request. Raises LookupError naming the first address not found.
+        """
+        import pandas as pd
+        from .predict_model import fill_coordinates
+
+        listings = [dict(listing) for listing in listings]
+        missing = [listing for listing in listings if listing.get('address') is not None
+                   and (listing.get('lat') is None or listing.get('lon') is None)]
+        if not missing:
+            return listings
+        coords = fill_coordinates(pd.DataFrame({'address': [x['address'] for x in missing]}),
+                                  self.cache_path, self.gazetteer_path, api=False)
+        for listing, lat, lon in zip(missing, coords['lat'], coords['lon']):
+            if pd.isna(lat) or pd.isna(lon):
+                raise LookupError("Address {!r} is not known, send its 'lat' and 'lon'"
+                                  .format(listing['address']))
+            listing['lat'], listing['lon'] = float(lat), float(lon)
+        return listings
+
+    def price(self, listings):
+        """
+        Price of each listing, from the cache or from the model.
+        """
+        keys = [json.dumps(listing, sort_keys=True) for listing in listings]
+        prices = [self.cache.get(key) for key in keys]
+        todo = [i for i, price in enumerate(prices) if price is None]
+        located = self.locate([listings[i] for i in todo])
+        futures = {i: self.batcher.submit(listing) for i, listing in zip(todo, located)}
+        for i, future in futures.items():
+            prices[i] = future.result(self.timeout)
+            self.cache.put(keys[i], prices[i])
+        return prices
+
+
+class PriceHandler(BaseHTTPRequestHandler):
+    """
+    Requests of PriceService, connections are kept alive between requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without Nagle they are not
+    # held back waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': 'Not found'})
+        cache = self.server.cache
+        self._send(200, {'status': 'ok', 'cached': len(cache), 'cache_hits': cache.hits,
+                         'cache_misses': cache.misses, 'batches': self.server.batcher.batches})
+
+    def _read_listings(self):
+        # Errors of the client, raised as ValueError before anything is priced
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ValueError('Invalid JSON')
+        listings = [body] if isinstance(body, dict) else body
+        if not isinstance(listings, list) or not all(isinstance(x, dict) for x in listings):
+            raise ValueError('Expected a listing or a list of listings')
+        for listing in listings:
+            validate_listing(listing)
+        return listings, isinstance(body, dict)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._send(404, {'error': 'Not found'})
+        try:
+            listings, single = self._read_listings()
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        try:
+            prices = self.server.price(listings)
+        except LookupError as e:
+            return self._send(422, {'error': str(e)})
+        except Exception as e:
+            logging.getLogger(__name__).exception('Pricing failed')
+            return self._send(500, {'error': 'Internal error: {}'.format(e)})
+        self._send(200, {'price': prices[0]} if single else {'prices': prices})
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8000, show_default=True)
+@click.option('--model', 'model_path', default=None,
+              help='Path of the .joblib model, the latest one in --models by default')
+@click.option('--models', 'model_dir', default='./models', show_default=True,
+              help='Folder of the versioned trained models')
+@click.option('--cache-size', type=int, default=10000, show_default=True,
+              help='Number of distinct listings whose price is kept')
+@click.option('--max-batch', type=int, default=256, show_default=True,
+              help='Maximum number of listings priced at once')
+@click.option('--max-wait', type=float, default=.005, show_default=True,
+              help='Seconds the first listing of a batch waits for others')
+def main(host, port, model_path, model_dir, cache_size, max_batch, max_wait):
+    """ Serve the price estimates of the trained model over HTTP."""
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    server = PriceService((host, port), model_path, model_dir, cache_size, max_batch, max_wait)
+    logging.getLogger(__name__).info('Serving prices on %s/predict', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
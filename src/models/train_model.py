@@ -1 +1,205 @@
 """Trains the best model selected from the notebooks analysis"""
+import json
+import logging
+import os
+import time
+
+from ..utils.instrument import instrumented, span
+
+# Features used by the model, the combined ones come from combine_features
+TARGET = 'price'
+COMBINED_FEATURES = ['bedrooms_per_area', 'distance_to_centre', 'distance_to_beach']
+NUMERIC_FEATURES = ['area', 'bathrooms', 'bedrooms', 'condo', 'parking_spots', 'suites',
+                    'lat', 'lon'] + COMBINED_FEATURES
+CATEGORICAL_FEATURES = ['type']
+
+# Search space of the hyperparameters of the regressor
+PARAM_DISTRIBUTIONS = {
+    'regressor__regressor__learning_rate': [.03, .05, .1, .2],
+    'regressor__regressor__max_leaf_nodes': [15, 31, 63, 127],
+    'regressor__regressor__min_samples_leaf': [5, 10, 20, 40],
+    'regressor__regressor__l2_regularization': [0., .1, 1., 10.],
+}
+
+MODEL_PREFIX = 'price-model-'
+
+
+def prepare_features(dataframe):
+    """
+    Select the model features, adding the combined ones when missing.
+    Columns become float, with NaN where the value is missing (also for
+    absent columns, values that are not numbers and infinite ratios),
+    imputed by the model.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Dataset with at least the scraped columns and 'lat', 'lon'
+
+    Returns
+    -------
+    features: pd.DataFrame
+        Features in the order expected by the model
+    """
+    import numpy as np
+    import pandas as pd
+    from ..features.combine_features import combine_features
+
+    # Numbers first, so the ratios tolerate absent and invalid values
+    features = dataframe.reindex(columns=NUMERIC_FEATURES)
+    features = features.apply(pd.to_numeric, errors='coerce').astype('float64')
+    missing = [col for col in COMBINED_FEATURES if col not in dataframe.columns]
+    if missing:
+        combined = combine_features(features.drop(columns=COMBINED_FEATURES), neighbourhood=False)
+        features[missing] = combined[missing]
+    features = features.replace([np.inf, -np.inf], np.nan)
+    for col in CATEGORICAL_FEATURES:
+        features[col] = dataframe[col].astype(object) if col in dataframe.columns else None
+    return features
+
+
+def build_pipeline(random_state=35):
+    """
+    Pipeline imputing and encoding the features of the gradient boosting
+    regressor, which is fitted on the log of the price.
+    """
+    import numpy as np
+    from sklearn.compose import ColumnTransformer, TransformedTargetRegressor
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from sklearn.impute import SimpleImputer
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder
+
+    preprocessing = ColumnTransformer([
+        ('numeric', SimpleImputer(strategy='median'), NUMERIC_FEATURES),
+        ('categorical', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL_FEATURES),
+    ])
+    regressor = TransformedTargetRegressor(
+        regressor=HistGradientBoostingRegressor(random_state=random_state),
+        func=np.log1p, inverse_func=np.expm1)
+    return Pipeline([('preprocessing', preprocessing), ('regressor', regressor)])
+
+
+def save_model(model, metadata, model_dir='./models'):
+    """
+    Persist the fitted model as a new version, with its metadata next to it.
+
+    Returns
+    -------
+    model_path: str
+        Path of the saved .joblib file
+    """
+    import joblib
+
+    os.makedirs(model_dir, exist_ok=True)
+    version = time.strftime('%Y%m%d-%H%M%S')
+    model_path = os.path.join(model_dir, MODEL_PREFIX + version + '.joblib')
+    metadata = dict(metadata, version=version)
+    joblib.dump(model, model_path, compress=3)
+    with open(os.path.splitext(model_path)[0] + '.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return model_path
+
+
+def latest_model(model_dir='./models'):
+    """
+    Path of the most recent model saved in model_dir, None if there is none.
+    """
+    if not os.path.isdir(model_dir):
+        return None
+    names = sorted(name for name in os.listdir(model_dir)
+                   if name.startswith(MODEL_PREFIX) and name.endswith('.joblib'))
+    return os.path.join(model_dir, names[-1]) if names else None
+
+
+@instrumented('model.train_model')
+def train_model(input_file='./data/processed/FINAL_DATA.csv', model_dir='./models', n_jobs=-1,
+                cv=5, factor=3, n_candidates=64, test_size=.2, random_state=35):
+    """
+    Search the hyperparameters of the model by successive halving, each
+    round training the surviving candidates on more listings, and persist
+    the best one.
+
+    Parameters
+    ----------
+    input_file: str
+        Dataset with the features (.csv, .parquet or .feather)
+    model_dir: str
+        Folder where the versioned models are saved
+    n_jobs: int
+        Number of candidates fitted in parallel, -1 uses all the cores
+    cv: int
+        Number of cross-validation folds
+    factor: int
+        Proportion of candidates kept (1 / factor) in each round
+    n_candidates: int or 'exhaust'
+        Number of candidates of the first round, 'exhaust' samples enough of
+        them for the last round to use all the training listings
+    test_size: float
+        Fraction of the listings held out to evaluate the best model
+    random_state: int
+        Seed of the split and the search
+
+    Returns
+    -------
+    model_path: str
+        Path of the saved model, its metadata is in the .json file next to it
+    """
+    import numpy as np
+    import sklearn
+    from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+    from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+    from sklearn.model_selection import HalvingRandomSearchCV, train_test_split
+
+    from ..data.storage import read_table
+
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+
+    # Features and target
+    data = read_table(input_file)
+    data = data[data[TARGET].notna()]
+    features = prepare_features(data)
+    target = data[TARGET].astype('float64')
+    X_train, X_test, y_train, y_test = train_test_split(
+        features, target, test_size=test_size, random_state=random_state)
+
+    # Successive halving search
+    search = HalvingRandomSearchCV(build_pipeline(random_state), PARAM_DISTRIBUTIONS,
+                                   n_candidates=n_candidates, factor=factor, cv=cv,
+                                   scoring='neg_mean_absolute_error', n_jobs=n_jobs,
+                                   random_state=random_state)
+    with span('model.fit', rows_in=len(X_train)):
+        search.fit(X_train, y_train)
+    logger.info('Best parameters %s (%d candidates in %d rounds)', search.best_params_,
+                search.n_candidates_[0], search.n_iterations_)
+
+    # Evaluation on the held out listings
+    predictions = search.best_estimator_.predict(X_test)
+    metrics = {'mae': mean_absolute_error(y_test, predictions),
+               'rmse': float(np.sqrt(mean_squared_error(y_test, predictions))),
+               'r2': r2_score(y_test, predictions)}
+    logger.info('Test metrics %s', metrics)
+
+    metadata = {
+        'input_file': input_file,
+        'rows': len(data),
+        'features': NUMERIC_FEATURES + CATEGORICAL_FEATURES,
+        'target': TARGET,
+        'best_params': search.best_params_,
+        'cv_mae': -float(search.best_score_),
+        'test_metrics': {name: float(value) for name, value in metrics.items()},
+        'candidates': [int(n) for n in search.n_candidates_],
+        'train_seconds': time.perf_counter() - start,
+        'sklearn_version': sklearn.__version__,
+    }
+    model_path = save_model(search.best_estimator_, metadata, model_dir)
+    logger.info('Model saved in %s', model_path)
+    return model_path
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    train_model()
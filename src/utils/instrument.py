@@ -0,0 +1,253 @@
+"""Instrumentation of the pipeline: timings, counters, memory and traces"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_memory():
+    """
+    Peak resident memory of the process so far, in bytes (0 if unknown).
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_memory():
+    """
+    Resident memory of the process now, in bytes (0 if unknown, as outside Linux).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+class Recorder:
+    """
+    Records a span for each instrumented stage or function call: its wall
+    time, the resident memory of the process at its end and how much it grew
+    during the span (memory, memory_delta), and the counters added while it
+    was the innermost span of its thread (rows_in, rows_out, bytes_read,
+    bytes_written, requests, ...). Disabled by default, so the instrumented
+    code only pays an attribute check. The spans recorded in worker
+    processes are brought back with recorded and merge.
+
+    Parameters
+    ----------
+    enabled: bool
+        Record the spans
+    profile: iterable
+        Names of the spans profiled with cProfile
+    profile_dir: str
+        Folder of the profiles, saved as profile-<name>.prof
+    """
+
+    def __init__(self, enabled=False, profile=(), profile_dir='.'):
+        self.enabled = enabled
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.events = []
+        self.totals = defaultdict(int)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, **counters):
+        """
+        Context manager recording a span, yielding its dict of counters.
+        """
+        if not self.enabled:
+            yield {}
+            return
+        args = defaultdict(int, counters)
+        stack = self._stack()
+        stack.append(args)
+        profiler = None
+        if name in self.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        memory = current_memory()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, 'profile-{}.prof'.format(name)))
+            stack.pop()
+            args['memory'] = current_memory()
+            args['memory_delta'] = args['memory'] - memory
+            event = {'name': name, 'start': start - self._start, 'seconds': end - start,
+                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': dict(args)}
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, n=1):
+        """
+        Add n to a counter of the innermost span of this thread and to the totals.
+        """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if stack:
+            stack[-1][name] += n
+        with self._lock:
+            self.totals[name] += n
+
+    def summary(self):
+        """
+        Calls, seconds and counters of each span name, with the largest
+        memory and memory_delta of its calls.
+        """
+        summary = {}
+        for event in self.events:
+            entry = summary.setdefault(event['name'], defaultdict(int))
+            entry['calls'] += 1
+            entry['seconds'] += event['seconds']
+            for key, value in event['args'].items():
+                if key in ('memory', 'memory_delta'):
+                    entry[key] = max(entry[key], value)
+                else:
+                    entry[key] += value
+        return {name: dict(entry) for name, entry in summary.items()}
+
+    def save_json(self, path):
+        """
+        Save the summary, the totals, the peak memory of the process and
+        every span as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'totals': dict(self.totals),
+                       'peak_memory': peak_memory(), 'events': self.events}, f, indent=1)
+
+    def save_chrome_trace(self, path):
+        """
+        Save the spans in the Chrome trace format (chrome://tracing, Perfetto).
+        """
+        trace = [{'name': event['name'], 'ph': 'X', 'ts': event['start'] * 1e6,
+                  'dur': event['seconds'] * 1e6, 'pid': event['pid'], 'tid': event['tid'],
+                  'args': event['args']} for event in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def state(self):
+        """
+        Settings of the recorder, to record the same way in a worker process
+        (see recorded).
+        """
+        return {'enabled': self.enabled, 'profile': sorted(self.profile),
+                'profile_dir': self.profile_dir, 'start': self._start}
+
+    def export(self):
+        """
+        Spans and totals recorded, to be merged in another recorder.
+        """
+        with self._lock:
+            return {'events': list(self.events), 'totals': dict(self.totals)}
+
+    def merge(self, recorded):
+        """
+        Add the spans and totals exported by another recorder (e.g. of a
+        worker process, see recorded).
+        """
+        with self._lock:
+            self.events.extend(recorded['events'])
+            for name, n in recorded['totals'].items():
+                self.totals[name] += n
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+            self.totals = defaultdict(int)
+            self._start = time.perf_counter()
+            self._local = threading.local()
+
+
+# Recorder of the pipeline, see enable
+RECORDER = Recorder()
+
+
+def enable(profile=(), profile_dir='.'):
+    """
+    Start recording the spans of the pipeline, optionally profiling some of them.
+    """
+    RECORDER.enabled = True
+    RECORDER.profile = set(profile)
+    RECORDER.profile_dir = profile_dir
+    return RECORDER
+
+
+def recorded(state, func, *args, **kwargs):
+    """
+    Call func in a worker process, recording as the parent recorder whose
+    state (see Recorder.state) is given. Returns the result and what was
+    recorded, to be merged with Recorder.merge by the parent.
+    """
+    # Forked workers inherit the spans of the parent, which are not theirs
+    RECORDER.clear()
+    RECORDER.enabled = state['enabled']
+    RECORDER.profile = set(state['profile'])
+    RECORDER.profile_dir = state['profile_dir']
+    # perf_counter is shared by the processes of the machine, so the spans line up
+    RECORDER._start = state['start']
+    result = func(*args, **kwargs)
+    return result, RECORDER.export()
+
+
+def span(name, **counters):
+    """
+    Span of the pipeline recorder, see Recorder.span.
+    """
+    return RECORDER.span(name, **counters)
+
+
+def count(name, n=1):
+    """
+    Add to a counter of the pipeline recorder, see Recorder.count.
+    """
+    RECORDER.count(name, n)
+
+
+def instrumented(name):
+    """
+    Decorator recording a span for each call of the function. The length of
+    a DataFrame (or array) first argument and result are counted as rows_in
+    and rows_out.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not RECORDER.enabled:
+                return func(*args, **kwargs)
+            with RECORDER.span(name) as counters:
+                if args and hasattr(args[0], 'shape'):
+                    counters['rows_in'] += len(args[0])
+                result = func(*args, **kwargs)
+                if hasattr(result, 'shape'):
+                    counters['rows_out'] += len(result)
+                return result
+        return wrapper
+    return decorator
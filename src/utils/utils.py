@@ -1,4 +1,6 @@
 """Utilities funcitons"""
+import threading
+import time
 
 
 def in_ipynb():
@@ -10,3 +12,113 @@ def in_ipynb():
             return True
     except NameError:
         return False
+
+
+def get_spinner(text):
+    """
+    Halo spinner suited to where the code runs (terminal or notebook).
+    halo is only imported when a spinner is actually needed.
+    """
+    if in_ipynb():
+        from halo import HaloNotebook as Halo
+    else:
+        from halo import Halo
+    return Halo(text=text, spinner='dots')
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting how often an action can happen.
+
+    Parameters
+    ----------
+    rate: float or None
+        Maximum number of acquisitions per second. None disables the limit.
+    burst: int
+        Number of acquisitions allowed back-to-back before throttling.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # Refill tokens since last call
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    Token bucket whose rate follows the limits observed from the provider:
+    halved each time a request is throttled, also pausing for the time asked
+    by the provider, and slowly raised back to the maximum rate while the
+    requests succeed.
+
+    Parameters
+    ----------
+    rate: float
+        Maximum number of acquisitions per second.
+    min_rate: float or None
+        Lowest rate after backing off. (default to rate / 16)
+    burst: int
+        Number of acquisitions allowed back-to-back before throttling.
+    increase: float
+        Fraction of the maximum rate recovered after each success.
+    """
+
+    def __init__(self, rate, min_rate=None, burst=1, increase=.05):
+        super().__init__(rate, burst)
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.increase = increase
+        self._paused_until = 0.
+
+    def acquire(self):
+        """
+        Block until the pause asked by the provider is over and a token is
+        available, then consume it.
+        """
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        super().acquire()
+
+    def penalize(self, retry_after=None):
+        """
+        Back off after a throttled request.
+
+        Parameters
+        ----------
+        retry_after: float or None
+            Seconds the provider asked to wait before the next request.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def reward(self):
+        """
+        Speed up after a successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase * self.max_rate)
@@ -1,13 +1,60 @@
 """Visualizations for the data"""
-import folium
-import matplotlib.pyplot as plt
-import seaborn as sns
-from folium import plugins
+import numpy as np
 
+# JavaScript of the coloured markers of FastMarkerCluster, each row is [lat, lon, colour]
+_COLOURED_MARKER = """
+function (row) {
+    return L.circleMarker(new L.LatLng(row[0], row[1]),
+                          {radius: 5, color: row[2], fillColor: row[2], fillOpacity: 0.8, weight: 1});
+}
+"""
 
-def plot_coordinates(dataframe, save_path=None):
+
+def reduce_points(dataframe, max_points=50000, method='bin', bin_size=.001, random_state=0):
     """
-    Dynamic plot of 'lat' and 'lon' coordinates.
+    Reduce the listings to at most about max_points points to be drawn.
+
+    Parameters
+    ----------
+    dataframe: pd.DataFrame
+        Listings with 'lat' and 'lon' (and optionally 'value')
+    max_points: int
+        Number of points above which the listings are reduced
+    method: str
+        'bin' aggregates the listings in cells of bin_size degrees, at the
+        mean position of each cell, with their 'count' and median 'value'.
+        'sample' draws a random sample of max_points listings
+    bin_size: float
+        Size of the cells in degrees (0.001 is about 110 m)
+    random_state: int
+        Seed of the sample
+
+    Returns
+    -------
+    points: pd.DataFrame
+        'lat', 'lon', 'count' (listings of each point) and 'value' if given
+    """
+    points = dataframe.assign(count=1)
+    if len(points) <= max_points:
+        return points
+    if method == 'sample':
+        return points.sample(max_points, random_state=random_state)
+    if method != 'bin':
+        raise ValueError("Unknown method: {}".format(method))
+
+    cells = [(points['lat'] // bin_size).astype('int64'), (points['lon'] // bin_size).astype('int64')]
+    aggregations = {'lat': ('lat', 'mean'), 'lon': ('lon', 'mean'), 'count': ('count', 'sum')}
+    if 'value' in points.columns:
+        aggregations['value'] = ('value', 'median')
+    return points.groupby(cells).agg(**aggregations).reset_index(drop=True)
+
+
+def plot_coordinates(dataframe, save_path=None, mode='cluster', color_by=None, max_points=50000,
+                     reduce='bin', bin_size=.001):
+    """
+    Dynamic plot of 'lat' and 'lon' coordinates. The coordinates are passed
+    to the map in bulk, and above max_points listings they are binned or
+    sampled (see reduce_points), so large sets build fast and stay small.
 
     Parameters
     ----------
@@ -15,17 +62,60 @@ def plot_coordinates(dataframe, save_path=None):
         Source dataframe with 'lat' and 'lon' columns
     save_path: str or None
         Where the map will be saved
+    mode: str
+        'cluster' for clustered markers or 'heatmap' for a density heatmap
+    color_by: str or None
+        Colour the markers by 'price_per_area' (price / area) or any numeric
+        column, only in 'cluster' mode
+    max_points: int
+        Number of points above which the listings are reduced
+    reduce: str
+        'bin' or 'sample', how the listings are reduced
+    bin_size: float
+        Size of the bins in degrees
+
+    Returns
+    -------
+    m: folium.Map
+        Map with the listings
     """
+    import folium
+    from folium import plugins
+
+    # Only the columns drawn
+    points = dataframe[['lat', 'lon']].astype('float64')
+    if color_by == 'price_per_area':
+        points['value'] = (dataframe['price'].astype('float64')
+                           / dataframe['area'].astype('float64')).values
+    elif color_by is not None:
+        points['value'] = dataframe[color_by].astype('float64').values
+    points = points.dropna()
+    points = reduce_points(points, max_points, reduce, bin_size)
+    # About 1 m of precision, which keeps the html small
+    points[['lat', 'lon']] = points[['lat', 'lon']].round(5)
+
     # Folium's Map object
-    m = folium.Map(location=[dataframe.lat.mean(),
-                             dataframe.lon.mean()], zoom_start=12)
+    m = folium.Map(location=[points.lat.mean(), points.lon.mean()], zoom_start=12)
 
-    # Markers
-    marker_cluster = plugins.MarkerCluster().add_to(m)
+    if mode == 'heatmap':
+        plugins.HeatMap(points[['lat', 'lon', 'count']].values.tolist(), radius=12).add_to(m)
+    elif mode == 'cluster' and color_by is None:
+        plugins.FastMarkerCluster(points[['lat', 'lon']].values.tolist()).add_to(m)
+    elif mode == 'cluster':
+        import branca.colormap as cm
 
-    # Iterate over df
-    for i, obs in dataframe.iterrows():
-        folium.Marker(location=[obs['lat'], obs['lon']]).add_to(marker_cluster)
+        # Colour scale between the 5th and 95th percentiles of the values
+        low, high = points['value'].quantile([.05, .95])
+        colormap = cm.LinearColormap(['#2c7bb6', '#ffffbf', '#d7191c'], vmin=low, vmax=high,
+                                     caption=color_by)
+        # Values quantized to a palette, so colours are looked up in bulk
+        palette = np.array([colormap(v) for v in np.linspace(low, high, 64)])
+        steps = np.rint((points['value'].clip(low, high) - low) / (high - low or 1) * 63)
+        data = points[['lat', 'lon']].assign(colour=palette[steps.astype(int)]).values.tolist()
+        plugins.FastMarkerCluster(data, callback=_COLOURED_MARKER).add_to(m)
+        colormap.add_to(m)
+    else:
+        raise ValueError("Unknown mode: {}".format(mode))
 
     # Save map
     if save_path is not None:
@@ -45,6 +135,9 @@ def plot_correlations(dataframe):
     save_path : str
         Where the figure will be saved
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     corr_matrix = dataframe.corr()
     fig, ax = plt.subplots(figsize=(15, 10))
 